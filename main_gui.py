@@ -1,9 +1,11 @@
 import sys
+from PyQt5.QtCore import QThreadPool
 from PyQt5.QtWidgets import QApplication, QMainWindow, QFileDialog, QMessageBox
 from utils.gui_ui import Ui_MainWindow
-from utils.visualize_volume_functions import (visualize_skin, visualize_bone, visualize_heart_lung,
-                            visualize_skin_heart_lung, visualize_skin_bone_heart_lung,
-                            export_stl)
+from utils.gui_worker import PipelineWorker
+from utils.visualize_volume_functions import (build_skin_meshes, build_bone_meshes, build_heart_lung_meshes,
+                            build_skin_heart_lung_meshes, build_preview_meshes, build_with_lod,
+                            show_meshes, show_progressive, export_stl)
 from vedo import close
 
 class MainWindow(QMainWindow):
@@ -18,6 +20,11 @@ class MainWindow(QMainWindow):
         self.lung_path = ""
         self.output_dir = "./output_stl"
         
+        # Pipelines run on a background thread, one at a time, so further jobs are queued
+        self.thread_pool = QThreadPool()
+        self.thread_pool.setMaxThreadCount(1)
+        self.jobs = []
+        
         # Connect buttons
         self.ui.btnLoadVolume.clicked.connect(self.load_volume)
         self.ui.btnLoadHeart.clicked.connect(self.load_heart)
@@ -31,6 +38,7 @@ class MainWindow(QMainWindow):
         self.ui.btnViewAll.clicked.connect(self.view_all)
         self.ui.btnExportSTL.clicked.connect(self.export_stl_files)
         self.ui.btnCloseViz.clicked.connect(self.close_visualization)
+        self.ui.btnCancel.clicked.connect(self.cancel_jobs)
 
     def load_volume(self):
         fname, _ = QFileDialog.getOpenFileName(self, "Select Volume File", "", "NIFTI files (*.nii.gz)")
@@ -68,36 +76,77 @@ class MainWindow(QMainWindow):
             return False
         return True
 
+    def start_job(self, description, fn, *args, on_finished=None, **kwargs):
+        """Queue fn(*args, **kwargs) on the worker thread and report its progress in the status bar"""
+        worker = PipelineWorker(fn, *args, **kwargs)
+        worker.signals.progress.connect(lambda message: self.ui.statusbar.showMessage(f"{description}: {message}"))
+        worker.signals.finished.connect(lambda result: self.job_finished(worker, description, result, on_finished))
+        worker.signals.error.connect(lambda message: self.job_failed(worker, description, message))
+        worker.signals.cancelled.connect(lambda: self.job_cancelled(worker, description))
+        self.jobs.append(worker)
+        self.ui.btnCancel.setEnabled(True)
+        self.ui.statusbar.showMessage(f"{description}: queued ({len(self.jobs)} job(s) pending)")
+        self.thread_pool.start(worker)
+
+    def remove_job(self, worker):
+        if worker in self.jobs:
+            self.jobs.remove(worker)
+        self.ui.btnCancel.setEnabled(bool(self.jobs))
+
+    def job_finished(self, worker, description, result, on_finished):
+        self.remove_job(worker)
+        self.ui.statusbar.showMessage(f"{description}: done")
+        if on_finished is not None:
+            on_finished(result)
+
+    def job_failed(self, worker, description, message):
+        self.remove_job(worker)
+        self.ui.statusbar.showMessage(f"{description}: failed")
+        QMessageBox.critical(self, "Error", f"{description} failed: {message}")
+
+    def job_cancelled(self, worker, description):
+        self.remove_job(worker)
+        self.ui.statusbar.showMessage(f"{description}: cancelled")
+
+    def cancel_jobs(self):
+        for worker in self.jobs:
+            worker.cancel()
+        self.ui.statusbar.showMessage("Cancelling jobs...")
+
     def view_skin(self):
         if self.check_volume():
-            visualize_skin(self.volume_path)
+            self.start_job("View Skin", build_with_lod, build_skin_meshes, self.volume_path, on_finished=show_meshes)
 
     def view_bone(self):
         if self.check_volume():
-            visualize_bone(self.volume_path)
+            self.start_job("View Bone", build_with_lod, build_bone_meshes, self.volume_path, on_finished=show_meshes)
 
     def view_heart_lung(self):
         if self.check_heart_lung():
-            visualize_heart_lung(self.heart_path, self.lung_path)
+            self.start_job("View Heart & Lung", build_with_lod, build_heart_lung_meshes, self.heart_path, self.lung_path,
+                           on_finished=show_meshes)
 
     def view_skin_heart_lung(self):
         if self.check_volume() and self.check_heart_lung():
-            visualize_skin_heart_lung(self.volume_path, self.heart_path, self.lung_path)
+            self.start_job("View Skin, Heart & Lung", build_with_lod, build_skin_heart_lung_meshes, self.volume_path,
+                           self.heart_path, self.lung_path, on_finished=show_meshes)
 
     def view_all(self):
         if self.check_volume() and self.check_heart_lung():
-            visualize_skin_bone_heart_lung(self.volume_path, self.heart_path, self.lung_path)
+            # Show a downsampled preview first, the full-resolution organs replace it as they are built
+            volume_path, heart_path, lung_path = self.volume_path, self.heart_path, self.lung_path
+            self.start_job("View All", build_preview_meshes, volume_path, heart_path, lung_path,
+                           on_finished=lambda preview: show_progressive(preview, volume_path, heart_path, lung_path))
 
     def export_stl_files(self):
         if self.check_volume() and self.check_heart_lung():
             decimation = self.ui.spinDecimation.value() / 100.0
+            # A triangle budget replaces the uniform decimation and is shared between the organs
+            budget = self.ui.spinBudget.value() * 1000 or None
             filename = self.ui.lineFilename.text() or "volume"
-            try:
-                export_stl(filename, self.volume_path, self.heart_path, self.lung_path, 
-                          self.output_dir, decimation_factor=decimation)
-                QMessageBox.information(self, "Success", "STL files exported successfully!")
-            except Exception as e:
-                QMessageBox.critical(self, "Error", f"Failed to export STL files: {str(e)}")
+            self.start_job(f"Export {filename}", export_stl, filename, self.volume_path, self.heart_path,
+                           self.lung_path, self.output_dir, decimation_factor=decimation, triangle_budget=budget,
+                           on_finished=lambda result: QMessageBox.information(self, "Success", "STL files exported successfully!"))
 
     def close_visualization(self):
         close()
@@ -0,0 +1,211 @@
+import argparse
+import glob
+import os
+import re
+import sys
+from utils.visualize_volume_functions import (get_patient_paths, batch_export_stl, batch_render, stl_set_paths,
+                                              level_name, planned_name)
+from utils.volume_analysis import record_volume_sizes, get_nifti_path
+from utils.volume_index import DEFAULT_INDEX_PATH
+from utils.mesh_writer import MESH_FORMATS
+from utils.decimation import stl_triangle_budget
+from utils.mesh_cache import MESH_CACHE_VERSION, get_smoothing, get_resampling
+from utils.build_graph import DEFAULT_STATE_PATH, make_target, build
+from utils.creategif import create_mri_3d_gif, gif_inputs, FRAME_SIZE
+
+# Volume files and folders are named volume_N
+VOLUME_ID_PATTERN = re.compile(r'volume_(\d+)')
+
+
+def parse_volume_ids(specs, input_dir='input/volumes'):
+    """
+    Expand volume id arguments into a sorted list of volume numbers
+    Args:
+        specs: list of arguments, each a number (18), a range (1-181), a comma separated
+               list of those (1-10,42), or a glob pattern matching volume_N files (volume_1*.nii.gz);
+               patterns without a folder are looked up in input_dir
+        input_dir: folder with the volume_N.nii.gz body volumes
+    Returns:
+        sorted list of unique volume numbers
+    """
+    ids = set()
+    for spec in specs:
+        if any(c in spec for c in '*?['):
+            pattern = spec if os.path.dirname(spec) else os.path.join(input_dir, spec)
+            for path in glob.glob(pattern):
+                match = VOLUME_ID_PATTERN.search(os.path.basename(path))
+                if match:
+                    ids.add(int(match.group(1)))
+            continue
+        for part in spec.split(','):
+            if not part:
+                continue
+            if '-' in part:
+                start, stop = part.split('-', 1)
+                ids.update(range(int(start), int(stop) + 1))
+            else:
+                ids.add(int(part))
+    return sorted(ids)
+
+
+def mesh_params():
+    """Settings shared by every output built from the organ meshes"""
+    return {'mesh_version': MESH_CACHE_VERSION, 'smoothing': get_smoothing(), 'resampling': get_resampling()}
+
+
+def patient_target(kind, volume_id, outputs, args, params, variant=None):
+    """
+    Describe the outputs of one patient, built from its body volume and heart and lung masks
+    variant names the settings of the outputs, so each setting keeps its own build record
+    """
+    filename, volume_path, heart, lung = get_patient_paths(volume_id, args.input_dir, args.segmentation_dir)
+    name = f'{kind}:{os.path.normpath(args.output_dir)}/{filename}' + (f'[{variant}]' if variant else '')
+    return make_target(name, outputs, [volume_path, heart, lung], params)
+
+
+def export_command(args):
+    if args.max_bytes is not None:
+        args.triangle_budget = stl_triangle_budget(args.max_bytes)
+    planned = args.triangle_budget is not None or args.max_error is not None
+    if args.triangle_budget is not None:
+        variant = f'budget={args.triangle_budget}'
+    elif args.max_error is not None:
+        variant = f'max_error={args.max_error:g}'
+    else:
+        variant = 'decimation=' + ','.join(f'{factor:g}' for factor in args.decimation)
+    variant += f' format={args.format}'
+    targets = {}
+    for volume_id in parse_volume_ids(args.volumes, args.input_dir):
+        filename = f'volume_{volume_id}'
+        if planned:
+            names = [planned_name(filename, args.triangle_budget, args.max_error)]
+        else:
+            names = [level_name(filename, factor) for factor in args.decimation]
+        outputs = [path for name in names for path in stl_set_paths(name, args.output_dir, args.format)]
+        params = dict(mesh_params(), format=args.format, decimation=None if planned else args.decimation,
+                      triangle_budget=args.triangle_budget, max_error=args.max_error)
+        targets[volume_id] = patient_target('export', volume_id, outputs, args, params, variant)
+
+    def run(stale, done):
+        by_name = {target['name']: volume_id for volume_id, target in targets.items()}
+        batch_export_stl([by_name[target['name']] for target in stale], args.decimation, args.input_dir,
+                         args.segmentation_dir, args.output_dir, args.workers, args.format,
+                         on_done=lambda volume_id: done(targets[volume_id]),
+                         triangle_budget=args.triangle_budget, max_error=args.max_error)
+
+    build(list(targets.values()), run, args.state, args.dry_run, args.force)
+
+
+def render_command(args):
+    targets = {}
+    for volume_id in parse_volume_ids(args.volumes, args.input_dir):
+        output = f'{args.output_dir}/volume_{volume_id}.png'
+        targets[volume_id] = patient_target('render', volume_id, [output], args, mesh_params())
+
+    def run(stale, done):
+        by_name = {target['name']: volume_id for volume_id, target in targets.items()}
+        batch_render([by_name[target['name']] for target in stale], args.output_dir, args.input_dir,
+                     args.segmentation_dir, args.workers, on_done=lambda volume_id: done(targets[volume_id]))
+
+    build(list(targets.values()), run, args.state, args.dry_run, args.force)
+
+
+def measure_command(args):
+    ids = parse_volume_ids(args.volumes, args.input_dir)
+    targets = []
+    measured = {}
+    for organ in args.organs:
+        output_file = os.path.join(args.output_dir, f'{organ}_volume_sizes.txt')
+        # Scans without this mask are left out of the file, adding one later makes it stale
+        measured[organ] = [i for i in ids if os.path.exists(get_nifti_path(i, organ, args.segmentation_dir))]
+        inputs = [get_nifti_path(i, organ, args.segmentation_dir) for i in measured[organ]]
+        targets.append(make_target(f'measure:{os.path.normpath(output_file)}', [output_file], inputs,
+                                   {'organ': organ, 'volumes': ids}))
+
+    def run(stale, done):
+        os.makedirs(args.output_dir, exist_ok=True)
+        for target in stale:
+            organ = target['params']['organ']
+            output_file = target['outputs'][0]
+            # The file is rewritten in full; files already in the volume index are not read again
+            open(output_file, 'w').close()
+            record_volume_sizes(measured[organ], organ, output_file, args.workers, args.index,
+                                args.segmentation_dir)
+            print(f"{organ} volumes of {len(measured[organ])} scans written to {output_file}")
+            done(target)
+
+    build(targets, run, args.state, args.dry_run, args.force)
+
+
+def gif_command(args):
+    # Volumes without both masks are left out, adding them later makes the animation stale
+    ids = [i for i in parse_volume_ids(args.volumes, args.input_dir)
+           if all(os.path.exists(path) for path in gif_inputs([i], args.segmentation_dir))]
+    target = make_target(f'gif:{os.path.normpath(args.output)}', [args.output],
+                         gif_inputs(ids, args.segmentation_dir),
+                         dict(mesh_params(), volumes=ids, fps=args.fps, size=FRAME_SIZE))
+
+    def run(stale, done):
+        create_mri_3d_gif(ids, args.output, args.segmentation_dir, args.workers, args.fps)
+        done(target)
+
+    build([target], run, args.state, args.dry_run, args.force)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='mri', description="Batch export, measurement and rendering of MRI volumes, "
+                                                             "rebuilding only the stale outputs")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('volumes', nargs='+',
+                        help="volume ids: 18, 1-181, 1-10,42 or a glob such as 'volume_1*.nii.gz'")
+    common.add_argument('--input-dir', default='input/volumes', help="folder with the volume_N.nii.gz body volumes")
+    common.add_argument('--segmentation-dir', default='output', help="folder with the volume_N segmentation folders")
+    common.add_argument('--workers', type=int, default=None, help="worker processes (default: one per CPU)")
+    common.add_argument('--state', default=DEFAULT_STATE_PATH, help="file recording the inputs of every output")
+    common.add_argument('--dry-run', action='store_true', help="only list the outputs that would be rebuilt")
+    common.add_argument('--force', action='store_true', help="rebuild outputs that are up to date")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', parents=[common], help="export organ meshes")
+    export.add_argument('--output-dir', default='./output_stl')
+    reduction = export.add_mutually_exclusive_group()
+    reduction.add_argument('--decimation', type=float, nargs='+', default=[1.0],
+                           help="fractions of triangles kept, one output folder per value (e.g. 0.5 0.25)")
+    reduction.add_argument('--triangle-budget', type=int,
+                           help="total triangles of the four organs, shared by surface area")
+    reduction.add_argument('--max-bytes', type=int,
+                           help="largest size of the combined binary STL file, converted to a triangle budget")
+    reduction.add_argument('--max-error', type=float,
+                           help="largest distance in mm between each organ and its decimated mesh")
+    export.add_argument('--format', choices=MESH_FORMATS, default='stl',
+                        help="binary stl or ply files per organ, one glb, or one large ASCII multi_stl "
+                             "with named solids (compatibility only)")
+    export.set_defaults(run=export_command)
+
+    render = subparsers.add_parser('render', parents=[common], help="render offscreen screenshots")
+    render.add_argument('--output-dir', default='./output_img')
+    render.set_defaults(run=render_command)
+
+    measure = subparsers.add_parser('measure', parents=[common], help="record organ volumes")
+    measure.add_argument('--organs', nargs='+', default=['heart', 'lung'], choices=['heart', 'lung'])
+    measure.add_argument('--output-dir', default='.')
+    measure.add_argument('--index', default=DEFAULT_INDEX_PATH,
+                         help="volume index database, an empty string measures every file again")
+    measure.set_defaults(run=measure_command)
+
+    gif = subparsers.add_parser('gif', parents=[common], help="animate the heart and lungs of consecutive volumes")
+    gif.add_argument('--output', default='./output_img/mri_visualization.gif',
+                     help="animated .gif, or a video such as .mp4 (needs imageio-ffmpeg)")
+    gif.add_argument('--fps', type=float, default=1, help="frames per second")
+    gif.set_defaults(run=gif_command)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def mask_bounding_box(data, threshold=0):
+    """
+    Compute the tight bounding box of the voxels above threshold
+    Args:
+        data: 3D array
+        threshold: voxels with a value greater than this are inside the mask
+    Returns:
+        (start, stop) index tuples (stop exclusive), or None if no voxel is above threshold
+    """
+    mask = data > threshold
+    start = []
+    stop = []
+    for axis in range(mask.ndim):
+        # Project the mask onto each axis by reducing over the other axes
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        occupied = np.flatnonzero(mask.any(axis=other_axes))
+        if occupied.size == 0:
+            return None
+        start.append(int(occupied[0]))
+        stop.append(int(occupied[-1]) + 1)
+    return tuple(start), tuple(stop)
+
+
+def label_bounding_boxes(label_map, n_labels):
+    """
+    Compute the tight bounding box of every label of an integer label map
+    Each axis is handled with one scatter of the non-zero voxel coordinates into a
+    (label, position) presence table, so the cost is linear in the number of voxels.
+    Args:
+        label_map: 3D integer array, 0 is background
+        n_labels: highest label value
+    Returns:
+        dict {label: (start, stop)} with start/stop index tuples (stop exclusive), for the labels present
+    """
+    flat_index = np.flatnonzero(label_map)
+    labels = label_map.ravel()[flat_index]
+    coords = np.unravel_index(flat_index, label_map.shape)
+
+    starts = np.zeros((n_labels + 1, label_map.ndim), dtype=int)
+    stops = np.zeros((n_labels + 1, label_map.ndim), dtype=int)
+    for axis, size in enumerate(label_map.shape):
+        presence = np.zeros((n_labels + 1, size), dtype=bool)
+        presence[labels, coords[axis]] = True
+        starts[:, axis] = presence.argmax(axis=1)
+        stops[:, axis] = size - presence[:, ::-1].argmax(axis=1)
+
+    present = np.zeros(n_labels + 1, dtype=bool)
+    present[labels] = True
+    return {label: (tuple(starts[label]), tuple(stops[label]))
+            for label in range(1, n_labels + 1) if present[label]}
+
+
+def union_box(boxes):
+    """Return the smallest box containing every (start, stop) box"""
+    starts = np.min([start for start, _ in boxes], axis=0)
+    stops = np.max([stop for _, stop in boxes], axis=0)
+    return tuple(starts), tuple(stops)
+
+
+def pad_box(box, shape, pad=1):
+    """Grow a (start, stop) box by pad voxels on each side, clipped to the array shape"""
+    start, stop = box
+    start = tuple(max(0, s - pad) for s in start)
+    stop = tuple(min(n, s + pad) for s, n in zip(stop, shape))
+    return start, stop
+
+
+def box_slices(box):
+    """Return the index slices selecting a (start, stop) box"""
+    start, stop = box
+    return tuple(slice(s, e) for s, e in zip(start, stop))
@@ -0,0 +1,189 @@
+import json
+import os
+
+try:
+    from utils.volume_index import file_digest
+except ImportError:
+    # Running as a script from inside the utils folder
+    from volume_index import file_digest
+
+# Location of the build state file, overridable through the environment
+DEFAULT_STATE_PATH = os.environ.get('MRI_BUILD_STATE', 'build_state.json')
+BUILD_STATE_VERSION = 1
+
+
+def make_target(name, outputs, inputs, params=None):
+    """
+    Describe one build step
+    Args:
+        name: unique name of the step, e.g. 'export/volume_42'
+        outputs: list of files written by the step
+        inputs: list of files read by the step
+        params: JSON-serializable dict of the settings the outputs depend on
+    Returns:
+        target dict used by stale_targets and build
+    """
+    return {'name': name, 'outputs': list(outputs), 'inputs': list(inputs),
+            'params': json.loads(json.dumps(params or {}))}
+
+
+def load_state(state_path=DEFAULT_STATE_PATH):
+    """Load the recorded builds, or an empty state if the file is missing or from another version"""
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        state = {}
+    if state.get('version') != BUILD_STATE_VERSION:
+        state = {'version': BUILD_STATE_VERSION, 'targets': {}}
+    return state
+
+
+def save_state(state, state_path=DEFAULT_STATE_PATH):
+    """Write the state file atomically, so an interrupted run never leaves it truncated"""
+    folder = os.path.dirname(os.path.abspath(state_path))
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, state_path)
+
+
+def _digests(state):
+    """Index the content hashes already recorded in the state by (path, mtime, size)"""
+    digests = {}
+    for record in state['targets'].values():
+        for path, signature in record['inputs'].items():
+            digests[(path, signature['mtime_ns'], signature['size'])] = signature['sha1']
+    return digests
+
+
+def input_signature(path, digests):
+    """
+    Return the modification time, size and content hash of an input file
+    Hashes are looked up in digests (filled as a side effect) so each file is read at most once.
+    """
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    key = (real_path, stat.st_mtime_ns, stat.st_size)
+    if key not in digests:
+        digests[key] = file_digest(real_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': digests[key]}
+
+
+def stale_reason(target, state, digests):
+    """
+    Explain why a target has to be rebuilt
+    An input whose timestamp changed but whose content did not (e.g. a copied file) does
+    not make the target stale.
+    Returns:
+        None if the target is up to date, otherwise a short reason
+    """
+    record = state['targets'].get(target['name'])
+    if record is None:
+        return "never built"
+    missing = [path for path in target['outputs'] if not os.path.exists(path)]
+    if missing:
+        return f"missing {missing[0]}" + (f" and {len(missing) - 1} more" if len(missing) > 1 else "")
+    if record['params'] != target['params']:
+        changed = sorted(key for key in set(record['params']) | set(target['params'])
+                         if record['params'].get(key) != target['params'].get(key))
+        return f"changed {', '.join(changed)}"
+    if record['outputs'] != target['outputs']:
+        return "changed outputs"
+    recorded = record['inputs']
+    if set(recorded) != {os.path.realpath(path) for path in target['inputs']}:
+        return "changed inputs"
+    for path in target['inputs']:
+        real_path = os.path.realpath(path)
+        stat = os.stat(real_path)
+        signature = recorded[real_path]
+        if (signature['mtime_ns'], signature['size']) == (stat.st_mtime_ns, stat.st_size):
+            continue
+        if signature['size'] != stat.st_size or input_signature(path, digests)['sha1'] != signature['sha1']:
+            return f"modified {path}"
+    return None
+
+
+def input_signatures(target, digests):
+    """Return the signature of every input of a target, keyed by resolved path"""
+    return {os.path.realpath(path): input_signature(path, digests) for path in target['inputs']}
+
+
+def stale_targets(targets, state, force=False, sign=True):
+    """
+    Split targets into the ones to rebuild and the ones that cannot be built
+    The inputs of each stale target are signed here, before it is rebuilt, so an input
+    modified while the build runs leaves the target stale for the next run.
+    Args:
+        sign: take the input signatures of the stale targets (None otherwise, e.g. for a dry run)
+    Returns:
+        (stale, missing): lists of (target, reason, input signatures) and (target, reason);
+        targets with a missing input are only in missing
+    """
+    digests = _digests(state)
+    stale, missing = [], []
+    for target in targets:
+        absent = [path for path in target['inputs'] if not os.path.exists(path)]
+        if absent:
+            missing.append((target, f"missing input {absent[0]}"))
+            continue
+        reason = "forced" if force else stale_reason(target, state, digests)
+        if reason is not None:
+            stale.append((target, reason, input_signatures(target, digests) if sign else None))
+    return stale, missing
+
+
+def record_build(state, target, signatures):
+    """
+    Record a target as built
+    Args:
+        state: state returned by load_state
+        target: target dict
+        signatures: input signatures taken by stale_targets before the target was rebuilt
+    """
+    state['targets'][target['name']] = {
+        'outputs': target['outputs'],
+        'params': target['params'],
+        'inputs': signatures,
+    }
+
+
+def build(targets, run, state_path=DEFAULT_STATE_PATH, dry_run=False, force=False):
+    """
+    Rebuild the stale targets, make-style
+    Args:
+        targets: list of make_target dicts
+        run: function run(stale_targets, done) building the given targets; it calls
+             done(target) as each one finishes, so progress survives an interrupted run
+        state_path: JSON file recording the inputs and params of every built target
+        dry_run: only print what would be rebuilt
+        force: rebuild every target whose inputs exist
+    Returns:
+        list of the names of the targets that were rebuilt (or would be, with dry_run)
+    """
+    state = load_state(state_path)
+    stale, missing = stale_targets(targets, state, force, sign=not dry_run)
+    for target, reason in missing:
+        print(f"Skipping {target['name']}: {reason}")
+    for target, reason, _ in stale:
+        print(f"{'Would rebuild' if dry_run else 'Rebuilding'} {target['name']}: {reason}")
+    print(f"{len(stale)} of {len(targets)} targets stale, {len(targets) - len(stale) - len(missing)} up to date, "
+          f"{len(missing)} with missing inputs")
+    if dry_run or not stale:
+        return [target['name'] for target, _, _ in stale]
+
+    signatures = {target['name']: inputs for target, _, inputs in stale}
+    built = []
+
+    def done(target):
+        absent = [path for path in target['outputs'] if not os.path.exists(path)]
+        if absent:
+            print(f"{target['name']} did not write {absent[0]}, it stays stale")
+            return
+        record_build(state, target, signatures[target['name']])
+        save_state(state, state_path)
+        built.append(target['name'])
+
+    run([target for target, _, _ in stale], done)
+    return built
@@ -1,7 +1,16 @@
-from vedo import show, Volume, Text2D
-import nibabel as nib
+from vedo import show, Text2D
 import os
 
+try:
+    from utils.volume_cache import load_image
+    from utils.mesh_cache import cached_isosurface
+    from utils.label_meshes import cached_label_surfaces
+except ImportError:
+    # Running as a script from inside the utils folder
+    from volume_cache import load_image
+    from mesh_cache import cached_isosurface
+    from label_meshes import cached_label_surfaces
+
 # Define a list of 20 visually distinguishable colors
 COLORS_20 = [
     'red', 'blue', 'green', 'yellow', 'purple',
@@ -10,25 +19,33 @@ COLORS_20 = [
     'turquoise', 'salmon', 'olive', 'skyblue', 'maroon'
 ]
 
-def visualize_mri_3d_mesh(mri_files, colors=None):
+def visualize_mri_3d_mesh(mri_files, colors=None, label_map=False):
     """
     Visualize multiple MRI files in the same 3D plot using isosurfaces
     mri_files: list of file paths
     colors: list of colors for each structure
+    label_map: merge the structure masks into one label map and extract all surfaces
+               in a single pass, faster for many structures; a voxel can only hold one
+               label, so where masks overlap the later file keeps the voxel and the earlier
+               structure's surface is cut there. By default each file is contoured on its own.
     """
     if colors is None:
         colors = ['red', 'blue', 'green']
+    mri_files = list(mri_files)[:len(colors)]
+    
+    if label_map:
+        meshes = cached_label_surfaces(mri_files)
+    else:
+        meshes = [cached_isosurface(file, 0.5) for file in mri_files]
     
     volumes = []
     # Create legend text
     legend_text = ""
     
-    for file, color in zip(mri_files, colors):
-        img = nib.load(file)
-        data = img.get_fdata()
-        vol = Volume(data, spacing=(1,1,3))
-        mesh = vol.isosurface(0.5)
-        mesh.smooth(niter=20)
+    for file, color, mesh in zip(mri_files, colors, meshes):
+        if mesh is None:
+            print(f"{os.path.basename(file)} is empty, skipping")
+            continue
         mesh.color(color)
         mesh.alpha(0.6)
         volumes.append(mesh)
@@ -43,9 +60,8 @@ def visualize_mri_3d_mesh(mri_files, colors=None):
     show(volumes, bg='black', axes=1)
     
 def print_info(mri_file, patient_name):
-    img = nib.load(mri_file)
-    data = img.get_fdata()
-    print(f'{patient_name} : {data.shape}')
+    img = load_image(mri_file)
+    print(f'{patient_name} : {img.shape}')
 
 if __name__ == "__main__":
 
@@ -1,51 +1,124 @@
-from vedo import Volume, Text2D, Plotter
-import nibabel as nib
+from vedo import Text2D, Plotter
+from nibabel.filebasedimages import ImageFileError
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import imageio.v2 as imageio
-import glob
 import os
 
-def create_mri_3d_gif():
-    colors = ['red', 'yellow']
-    
-    frames = []
-    for i in range(12, 19):
+try:
+    from utils.mesh_cache import cached_isosurface
+except ImportError:
+    # Running as a script from inside the utils folder
+    from mesh_cache import cached_isosurface
+
+# Size (width, height) of the rendered frames
+FRAME_SIZE = (1000, 800)
+
+def gif_inputs(volume_ids, segmentation_dir="../output"):
+    """Return the heart and lung masks read for each frame of the GIF"""
+    paths = []
+    for i in volume_ids:
         filename = f"volume_{i}"
-        path_nifti_heart = f"../output/{filename}/{filename}_Heart.nii.gz"
-        path_nifti_lung = f"../output/{filename}/{filename}_Auto_Lung.nii.gz"
-        
-        mri_files = [path_nifti_heart, path_nifti_lung]
-        volumes = []
-        for file, color in zip(mri_files, colors):
-            img = nib.load(file)
-            data = img.get_fdata()
-            vol = Volume(data, spacing=(1,1,3))
-            mesh = vol.isosurface(0.5)
-            # mesh.rotate(angle=-90, axis=(0,0,1))  # Rotate axis = (x, y, z)
-            mesh.smooth(niter=20)
-            mesh.color(color)
-            mesh.alpha(0.6)
-            volumes.append(mesh)    
-        
-        # Render the scene and capture the frame
-        plt = Plotter(offscreen=True, axes=1)
-        txt = Text2D(f"Volume {i}", pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-        plt.show(volumes + [txt], bg='black', interactive=False, elevation=-90)
-        plt.screenshot(f'../img/frame_{i:03d}.png')
-        plt.clear()
-        volumes.clear()
-    
-    # Create GIF from the saved frames
-    
-    frames = []
-    for filename in sorted(glob.glob('../img/frame_*.png')):
-        frames.append(imageio.imread(filename))
-    
-    imageio.mimsave('../img/mri_visualization.gif', frames, duration=1000, loop=0)
-    
-    # Clean up temporary files
-    for filename in glob.glob('../img/frame_*.png'):
-        os.remove(filename)
+        paths += [f"{segmentation_dir}/{filename}/{filename}_Heart.nii.gz",
+                  f"{segmentation_dir}/{filename}/{filename}_Auto_Lung.nii.gz"]
+    return paths
+
+def render_frame(volume_id, segmentation_dir="../output", size=FRAME_SIZE):
+    """Render the heart and lungs of one volume offscreen and return the image as an (h, w, 3) array"""
+    colors = ['red', 'yellow']
+    volumes = []
+    for file, color in zip(gif_inputs([volume_id], segmentation_dir), colors):
+        mesh = cached_isosurface(file, 0.5)
+        # mesh.rotate(angle=-90, axis=(0,0,1))  # Rotate axis = (x, y, z)
+        mesh.color(color)
+        mesh.alpha(0.6)
+        volumes.append(mesh)
+
+    plt = Plotter(offscreen=True, axes=1, size=size)
+    txt = Text2D(f"Volume {volume_id}", pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
+    plt.show(volumes + [txt], bg='black', interactive=False, elevation=-90)
+    frame = plt.screenshot(asarray=True)
+    plt.close()
+    return frame
+
+def render_frames(volume_ids, segmentation_dir="../output", workers=None, max_in_flight=None, size=FRAME_SIZE):
+    """
+    Render frames in worker processes and yield them in the order of volume_ids
+    Args:
+        volume_ids: volume numbers, one frame each
+        segmentation_dir: folder with the volume_N/volume_N_Heart|Auto_Lung.nii.gz masks
+        workers: number of worker processes (None for one per CPU, 1 renders in this process)
+        max_in_flight: most frames rendered or waiting to be consumed at once (default 2 per worker),
+                       which bounds the memory of the render window whatever the number of volumes
+        size: (width, height) of the frames
+    Yields:
+        (volume id, frame array); volumes with missing masks are reported and skipped
+    """
+    def result(volume_id, render):
+        try:
+            return render()
+        except (FileNotFoundError, ImageFileError) as e:
+            print(f"Skipping volume_{volume_id}: {e}")
+            return None
+
+    if workers == 1:
+        for volume_id in volume_ids:
+            frame = result(volume_id, lambda: render_frame(volume_id, segmentation_dir, size))
+            if frame is not None:
+                yield volume_id, frame
+        return
+
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for volume_id in volume_ids:
+            pending.append((volume_id, pool.submit(render_frame, volume_id, segmentation_dir, size)))
+            # Wait for the oldest frame before submitting more once the window is full
+            while len(pending) >= max_in_flight or (pending and pending[0][1].done()):
+                done_id, future = pending.popleft()
+                frame = result(done_id, future.result)
+                if frame is not None:
+                    yield done_id, frame
+        while pending:
+            done_id, future = pending.popleft()
+            frame = result(done_id, future.result)
+            if frame is not None:
+                yield done_id, frame
+
+def create_mri_3d_gif(volume_ids=range(12, 19), output_path='../img/mri_visualization.gif',
+                      segmentation_dir="../output", workers=None, fps=1, max_in_flight=None):
+    """
+    Render the heart and lungs of consecutive volumes as the frames of an animated GIF or video
+    Frames are rendered in parallel and streamed to the encoder as arrays, without image files;
+    the encoder writes each frame to disk as it arrives, so memory does not grow with the number of frames.
+    Args:
+        volume_ids: volume numbers, one frame each
+        output_path: .gif file, or a video such as .mp4 (needs the imageio-ffmpeg package)
+        segmentation_dir: folder with the volume_N/volume_N_Heart|Auto_Lung.nii.gz masks
+        workers: number of worker processes, see render_frames
+        fps: frames per second
+        max_in_flight: most frames held in memory before they are encoded, see render_frames
+    Returns:
+        number of frames written
+    """
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    if output_path.lower().endswith('.gif'):
+        # The default Pillow writer keeps every frame until the file is closed, the GIF-PIL
+        # writer appends each frame to the file (its duration is in seconds)
+        options = {'format': 'GIF-PIL', 'mode': 'I', 'duration': 1 / fps, 'loop': 0}
+    else:
+        options = {'fps': fps}
+
+    count = 0
+    with imageio.get_writer(output_path, **options) as writer:
+        for volume_id, frame in render_frames(volume_ids, segmentation_dir, workers, max_in_flight):
+            writer.append_data(frame)
+            count += 1
+            print(f"Added frame of volume_{volume_id}")
+    print(f"{count} frames written to {output_path}")
+    return count
 
 if __name__ == "__main__":
 
-    create_mri_3d_gif()
\ No newline at end of file
+    create_mri_3d_gif()
@@ -0,0 +1,120 @@
+import numpy as np
+
+# Size of one triangle in a binary STL file (normal, 3 vertices and an attribute word)
+STL_TRIANGLE_BYTES = 50
+STL_HEADER_BYTES = 84
+
+# Smallest fraction of triangles kept when searching for a maximum error
+MIN_FRACTION = 0.001
+
+
+def triangle_count(mesh):
+    """Return the number of triangles of a mesh, without the line and vertex cells left by smoothing"""
+    return mesh.polydata().GetNumberOfPolys()
+
+
+def stl_triangle_budget(max_bytes):
+    """Return the number of triangles that fit in a binary STL file of max_bytes"""
+    return max(0, (int(max_bytes) - STL_HEADER_BYTES) // STL_TRIANGLE_BYTES)
+
+
+def allocate_triangle_budget(counts, budget, weights=None, min_triangles=100):
+    """
+    Split a total triangle budget between meshes by water-filling
+    Every non-empty mesh first gets min_triangles (fewer if the budget cannot give that to all
+    of them), then each gets a share of the rest proportional to its weight; meshes whose share
+    exceeds their current triangle count keep all of their triangles, and the budget they
+    leave is shared again between the other meshes. The targets never add up to more than
+    the budget.
+    Args:
+        counts: dict {name: current number of triangles}
+        budget: total number of triangles of the decimated meshes
+        weights: dict {name: weight}, e.g. surface areas for a uniform triangle density;
+                 None shares the budget in proportion to the current triangle counts
+        min_triangles: fewest triangles given to a non-empty mesh
+    Returns:
+        dict {name: target number of triangles}
+    """
+    weights = weights or counts
+    budget = max(int(budget), 0)
+    active = [name for name in counts if counts[name] > 0]
+    # The floor is reserved before the water-fill so it cannot push the total over the budget
+    floor = min(min_triangles, budget // len(active)) if active else 0
+    targets = {name: min(counts[name], floor) for name in counts}
+    remaining = budget - sum(targets.values())
+    active = [name for name in active if counts[name] > targets[name]]
+    while active:
+        total_weight = sum(weights[name] for name in active)
+        shares = {name: remaining * weights[name] / total_weight if total_weight else remaining / len(active)
+                  for name in active}
+        full = [name for name in active if targets[name] + shares[name] >= counts[name]]
+        if not full:
+            for name in active:
+                targets[name] += int(shares[name])
+            break
+        # These meshes are below their share, keep them whole and share their surplus again
+        for name in full:
+            remaining -= counts[name] - targets[name]
+            targets[name] = counts[name]
+            active.remove(name)
+
+    if sum(targets.values()) > budget:
+        raise RuntimeError(f"Triangle targets add up to {sum(targets.values())}, over the budget of {budget}")
+    return targets
+
+
+def decimation_error(mesh, fraction):
+    """Return the decimated copy of a mesh and its Hausdorff distance to the original"""
+    decimated = mesh.clone().decimate(fraction)
+    return decimated, decimated.hausdorff_distance(mesh)
+
+
+def fraction_for_error(mesh, max_error, steps=7):
+    """
+    Find the smallest fraction of triangles whose decimation stays within max_error of the mesh
+    The fraction is searched by bisection on a log scale between MIN_FRACTION and 1.
+    Args:
+        mesh: vedo mesh
+        max_error: largest Hausdorff distance allowed, in the units of the mesh (mm)
+        steps: number of bisection steps
+    Returns:
+        fraction of triangles to keep
+    """
+    if triangle_count(mesh) == 0:
+        return 1.0
+    lo, hi = np.log(MIN_FRACTION), 0.0
+    if decimation_error(mesh, MIN_FRACTION)[1] <= max_error:
+        return MIN_FRACTION
+    for _ in range(steps):
+        mid = (lo + hi) / 2
+        if decimation_error(mesh, float(np.exp(mid)))[1] <= max_error:
+            hi = mid
+        else:
+            lo = mid
+    return float(np.exp(hi))
+
+
+def plan_decimation(meshes, triangle_budget=None, max_error=None):
+    """
+    Choose the fraction of triangles kept for each mesh from a total budget or an error bound
+    Args:
+        meshes: dict {name: vedo mesh}
+        triangle_budget: total triangles of all meshes after decimation, shared in
+                         proportion to surface area so every organ gets the same density
+        max_error: largest Hausdorff distance (mm) between each mesh and its decimated copy
+    Returns:
+        dict {name: fraction of triangles to keep}
+    """
+    if (triangle_budget is None) == (max_error is None):
+        raise ValueError("Give either triangle_budget or max_error")
+    counts = {name: triangle_count(mesh) for name, mesh in meshes.items()}
+    if triangle_budget is not None:
+        areas = {name: mesh.area() if counts[name] else 0 for name, mesh in meshes.items()}
+        targets = allocate_triangle_budget(counts, triangle_budget, areas)
+        fractions = {name: targets[name] / counts[name] if counts[name] else 1.0 for name in meshes}
+    else:
+        fractions = {name: fraction_for_error(mesh, max_error) for name, mesh in meshes.items()}
+
+    for name, fraction in fractions.items():
+        print(f"{name}: {counts[name]} -> {round(counts[name] * fraction)} triangles ({fraction:.1%})")
+    return fractions
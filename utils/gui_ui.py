@@ -69,13 +69,19 @@ class Ui_MainWindow(object):
         self.spinDecimation = QtWidgets.QSpinBox()
         self.spinDecimation.setRange(1, 100)
         self.spinDecimation.setValue(50)
+        self.labelBudget = QtWidgets.QLabel("Triangle budget (k, 0 = off):")
+        self.spinBudget = QtWidgets.QSpinBox()
+        self.spinBudget.setRange(0, 100000)
+        self.spinBudget.setValue(0)
         self.btnExportSTL = QtWidgets.QPushButton("Export STL")
         
         self.exportLayout.addWidget(self.labelFilename, 0, 0)
         self.exportLayout.addWidget(self.lineFilename, 0, 1)
         self.exportLayout.addWidget(self.labelDecimation, 1, 0)
         self.exportLayout.addWidget(self.spinDecimation, 1, 1)
-        self.exportLayout.addWidget(self.btnExportSTL, 2, 0, 1, 2)
+        self.exportLayout.addWidget(self.labelBudget, 2, 0)
+        self.exportLayout.addWidget(self.spinBudget, 2, 1)
+        self.exportLayout.addWidget(self.btnExportSTL, 3, 0, 1, 2)
         
         self.groupExport.setLayout(self.exportLayout)
         self.mainLayout.addWidget(self.groupExport)
@@ -84,6 +90,11 @@ class Ui_MainWindow(object):
         self.btnCloseViz.setObjectName("btnCloseViz")
         self.mainLayout.addWidget(self.btnCloseViz)
         
+        self.btnCancel = QtWidgets.QPushButton(self.centralwidget)
+        self.btnCancel.setObjectName("btnCancel")
+        self.btnCancel.setEnabled(False)
+        self.mainLayout.addWidget(self.btnCancel)
+        
         MainWindow.setCentralWidget(self.centralwidget)
         
         # Menu bar
@@ -102,3 +113,4 @@ class Ui_MainWindow(object):
         _translate = QtCore.QCoreApplication.translate
         MainWindow.setWindowTitle(_translate("MainWindow", "MRI Visualization Tool"))
         self.btnCloseViz.setText(_translate("MainWindow", "Close Visualization"))
+        self.btnCancel.setText(_translate("MainWindow", "Cancel Running Jobs"))
@@ -0,0 +1,56 @@
+import threading
+import traceback
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+
+class JobCancelled(Exception):
+    """Raised inside a pipeline when its job has been cancelled"""
+
+
+class WorkerSignals(QObject):
+    """Signals emitted by a PipelineWorker, delivered on the GUI thread"""
+    progress = pyqtSignal(str)
+    finished = pyqtSignal(object)
+    error = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+
+class PipelineWorker(QRunnable):
+    """
+    Run a load/isosurface/smooth pipeline function on a QThreadPool thread
+    The function is called with a progress= keyword argument; every progress
+    message is forwarded to the progress signal and is also the point where a
+    cancelled job stops, by raising JobCancelled inside the pipeline.
+    """
+
+    def __init__(self, fn, *args, **kwargs):
+        super(PipelineWorker, self).__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        """Ask the job to stop at its next progress report"""
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def _progress(self, message):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+        self.signals.progress.emit(message)
+
+    def run(self):
+        try:
+            self._progress("Starting")
+            result = self.fn(*self.args, progress=self._progress, **self.kwargs)
+        except JobCancelled:
+            self.signals.cancelled.emit()
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.error.emit(str(e))
+        else:
+            self.signals.finished.emit(result)
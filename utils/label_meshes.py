@@ -0,0 +1,125 @@
+import numpy as np
+import vtk
+from vedo import Mesh, Volume
+
+try:
+    from utils.mesh_cache import (get_mesh_cache_dir, get_resampling, mesh_key, source_digest, load_cached_mesh,
+                                  save_cached_mesh, split_isosurfaces, load_mesh_source, header_spacing, voxel_to_world,
+                                  transform_mesh, get_smoothing, smooth_mesh)
+    from utils.bounding_box import label_bounding_boxes, union_box, pad_box, box_slices
+except ImportError:
+    # Running as a script from inside the utils folder
+    from mesh_cache import (get_mesh_cache_dir, get_resampling, mesh_key, source_digest, load_cached_mesh,
+                            save_cached_mesh, split_isosurfaces, load_mesh_source, header_spacing, voxel_to_world,
+                            transform_mesh, get_smoothing, smooth_mesh)
+    from bounding_box import label_bounding_boxes, union_box, pad_box, box_slices
+
+
+def build_label_map(mask_paths):
+    """
+    Merge binary structure masks into one integer label map
+    Structure i (1-based, in the order of mask_paths) is written as label i on the voxels
+    above 0.5; where masks overlap, the later file wins.
+    Args:
+        mask_paths: list of segmentation .nii.gz files with the same grid
+    Returns:
+        (img of the first mask, label map as a uint8 (or uint16 for more than 255 structures) array)
+    """
+    dtype = np.uint8 if len(mask_paths) < 256 else np.uint16
+    # Masks are cut at 0.5 like the per-file isosurfaces, which also handles the blurred
+    # edges of resampled masks
+    threshold = 0.5
+    first_img = None
+    label_map = None
+    overlap = 0
+    for label, path in enumerate(mask_paths, 1):
+        img, data, _ = load_mesh_source(path)
+        if label_map is None:
+            first_img = img
+            label_map = np.zeros(data.shape, dtype=dtype)
+        elif data.shape != label_map.shape:
+            raise ValueError(f"{path} has shape {data.shape}, expected {label_map.shape}")
+        mask = data > threshold
+        overlap += np.count_nonzero(label_map[mask])
+        label_map[mask] = label
+    if overlap:
+        print(f"Warning: {overlap} voxels belong to more than one structure, the last structure was kept")
+    return first_img, label_map
+
+
+def extract_label_surfaces(label_map, labels, spacing=(1,1,1)):
+    """
+    Extract the surfaces of several labels in one discrete flying edges pass
+    The pass runs on the label map cropped to the bounding box of the requested labels.
+    Args:
+        label_map: 3D integer array
+        labels: list of label values
+        spacing: voxel spacing of the volume
+    Returns:
+        dict {label: unsmoothed vedo mesh}; labels absent from the map are left out
+    """
+    boxes = label_bounding_boxes(label_map, max(labels))
+    present = [label for label in labels if label in boxes]
+    if not present:
+        return {}
+
+    # Keep one background voxel around the structures so the surfaces stay closed
+    box = pad_box(union_box([boxes[label] for label in present]), label_map.shape)
+    cropped = np.ascontiguousarray(label_map[box_slices(box)])
+    vol = Volume(cropped, spacing=spacing, origin=np.multiply(box[0], spacing))
+
+    contour = vtk.vtkDiscreteFlyingEdges3D()
+    contour.SetInputData(vol.inputdata())
+    contour.ComputeNormalsOn()
+    contour.ComputeScalarsOn()
+    contour.SetNumberOfContours(len(present))
+    for i, label in enumerate(present):
+        contour.SetValue(i, label)
+    contour.Update()
+
+    surfaces = split_isosurfaces(Mesh(contour.GetOutput()), present)
+    return dict(zip(present, surfaces))
+
+
+def cached_label_surfaces(mask_paths, spacing=None, niter=20, world=False, smoothing=None):
+    """
+    Return the smoothed surface of every structure mask, extracted together from one label map
+    Args:
+        mask_paths: list of segmentation .nii.gz files with the same grid
+        spacing: voxel spacing override, None to use the spacing of the NIFTI header
+        niter: number of smoothing iterations
+        world: place the meshes in scanner coordinates with the NIFTI affine
+        smoothing: smoothing engine, see mesh_cache.smooth_mesh
+    Returns:
+        list of unstyled vedo meshes in the order of mask_paths (None for empty masks)
+    """
+    smoothing = smoothing or get_smoothing()
+    meshes = [None] * len(mask_paths)
+    keys = [None] * len(mask_paths)
+    if get_mesh_cache_dir() is not None:
+        # Overlaps are resolved across all masks, so every mesh depends on every source file
+        sources = [source_digest(path) for path in mask_paths]
+        params = {'spacing': None if spacing is None else list(spacing), 'niter': niter,
+                  'world': world, 'resample': get_resampling(), 'smoothing': smoothing, 'mask_threshold': 0.5}
+        keys = [mesh_key(path, label_map_sources=sources, label=label, **params)
+                for label, path in enumerate(mask_paths, 1)]
+        meshes = [load_cached_mesh(key) for key in keys]
+    missing = [label for label, mesh in enumerate(meshes, 1) if mesh is None]
+    if not missing:
+        return meshes
+
+    img, label_map = build_label_map(mask_paths)
+    if spacing is None:
+        spacing = header_spacing(img)
+    surfaces = extract_label_surfaces(label_map, missing, spacing)
+    for label in missing:
+        mesh = surfaces.get(label)
+        if mesh is None:
+            continue
+        mesh = smooth_mesh(mesh, niter, smoothing)
+        if world:
+            mesh = transform_mesh(mesh, voxel_to_world(img))
+        if keys[label - 1] is not None:
+            save_cached_mesh(keys[label - 1], mesh)
+        meshes[label - 1] = mesh
+    return meshes
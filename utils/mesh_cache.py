@@ -0,0 +1,555 @@
+import hashlib
+import json
+import os
+import re
+import time
+import numpy as np
+from vedo import Mesh, Volume
+from vtk.util.numpy_support import vtk_to_numpy
+
+try:
+    from utils.volume_cache import load_nifti
+    from utils.volume_index import file_digest
+    from utils.bounding_box import mask_bounding_box, pad_box, box_slices
+    from utils.normalization import normalized_thresholds
+    from utils.volume_store import resample_isotropic
+    from utils.smoothing import (SMOOTHING_METHODS, laplacian_smooth, taubin_smooth, vertex_adjacency,
+                                 vertex_normals)
+except ImportError:
+    # Running as a script from inside the utils folder
+    from volume_cache import load_nifti
+    from volume_index import file_digest
+    from bounding_box import mask_bounding_box, pad_box, box_slices
+    from normalization import normalized_thresholds
+    from volume_store import resample_isotropic
+    from smoothing import (SMOOTHING_METHODS, laplacian_smooth, taubin_smooth, vertex_adjacency,
+                           vertex_normals)
+
+# The cache folder can be moved with this environment variable, set it to an empty string to disable the cache
+MESH_CACHE_ENV_VAR = 'MRI_MESH_CACHE'
+DEFAULT_MESH_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mri', 'meshes')
+
+# Bump when the way meshes are generated changes, so older cache entries are ignored and pruned
+MESH_CACHE_VERSION = 3
+
+# Default size limit of the cache folder (2 GB), the least recently used entries are removed beyond it
+DEFAULT_MESH_CACHE_BUDGET = 2 * 1024 ** 3
+
+# Fractions of the full-resolution triangles kept by each level of detail
+LOD_LEVELS = (1.0, 0.5, 0.1, 0.02)
+
+_mesh_cache_dir = os.environ.get(MESH_CACHE_ENV_VAR, DEFAULT_MESH_CACHE_DIR) or None
+_mesh_cache_budget = DEFAULT_MESH_CACHE_BUDGET
+_digests = {}
+_resample_voxel_size = None
+_smoothing_method = 'vtk'
+
+
+def set_mesh_cache_dir(cache_dir):
+    """Set the folder used to store generated meshes (None disables the cache)"""
+    global _mesh_cache_dir
+    _mesh_cache_dir = cache_dir
+
+
+def get_mesh_cache_dir():
+    """Return the folder used to store generated meshes, or None if the cache is disabled"""
+    return _mesh_cache_dir
+
+
+def set_mesh_cache_budget(max_bytes):
+    """Set the maximum number of bytes kept in the mesh cache folder and prune it to fit"""
+    global _mesh_cache_budget
+    _mesh_cache_budget = max_bytes
+    prune_mesh_cache()
+
+
+def set_resampling(voxel_size):
+    """
+    Resample every volume to isotropic voxels of voxel_size mm before extracting surfaces,
+    so meshes from scanners with different slice thickness are built on the same grid.
+    Resampled volumes are stored by volume_store.resample_isotropic. None disables resampling.
+    """
+    global _resample_voxel_size
+    _resample_voxel_size = voxel_size
+
+
+def get_resampling():
+    """Return the isotropic voxel size volumes are resampled to, or None"""
+    return _resample_voxel_size
+
+
+def set_smoothing(method):
+    """
+    Choose the smoothing engine used when no smoothing argument is given
+    Args:
+        method: 'vtk' (windowed sinc filter), 'taubin' or 'laplacian' (NumPy engines of utils.smoothing)
+    """
+    global _smoothing_method
+    if method not in SMOOTHING_METHODS:
+        raise ValueError(f"Unknown smoothing method {method!r}, expected one of {SMOOTHING_METHODS}")
+    _smoothing_method = method
+
+
+def get_smoothing():
+    """Return the default smoothing engine"""
+    return _smoothing_method
+
+
+def header_spacing(img):
+    """Return the voxel spacing of the first three axes from a NIFTI header"""
+    return tuple(float(z) for z in img.header.get_zooms()[:3])
+
+
+def voxel_to_world(img):
+    """
+    Return the 4x4 matrix mapping mesh coordinates (voxel index times spacing) to the
+    scanner coordinates given by the NIFTI affine
+    """
+    return img.affine @ np.diag([1 / z for z in header_spacing(img)] + [1])
+
+
+def load_mesh_source(path, spacing=None):
+    """
+    Load a volume for surface extraction, resampled if set_resampling is active
+    Args:
+        path: path to the .nii.gz file
+        spacing: voxel spacing override, None to read it from the header
+    Returns:
+        (img, data, spacing)
+    """
+    if _resample_voxel_size is not None:
+        path = resample_isotropic(path, _resample_voxel_size)
+    img, data = load_nifti(path)
+    return img, data, header_spacing(img) if spacing is None else tuple(spacing)
+
+
+def transform_mesh(mesh, matrix):
+    """Return a copy of a mesh with its points and normals mapped through a 4x4 affine matrix"""
+    vertices, faces, normals = mesh_to_arrays(mesh)
+    linear = matrix[:3, :3]
+    vertices = vertices @ linear.T + matrix[:3, 3]
+    if normals is not None:
+        normals = normals @ np.linalg.inv(linear)
+        normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    if np.linalg.det(linear) < 0:
+        # A mirroring affine flips the triangle winding, restore it so the faces stay outward
+        faces = faces[:, ::-1]
+    return arrays_to_mesh(vertices.astype(np.float32), np.ascontiguousarray(faces), normals)
+
+
+def source_digest(path):
+    """Return the content hash of a source file, hashing each version of the file only once per process"""
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    key = (real_path, stat.st_mtime_ns, stat.st_size)
+    if key not in _digests:
+        _digests[key] = file_digest(real_path)
+    return _digests[key]
+
+
+def mesh_key(path, **params):
+    """
+    Build the cache key of a mesh generated from a NIFTI file
+    Args:
+        path: source .nii.gz file
+        params: every parameter that influences the mesh (threshold, spacing, smoothing...)
+    """
+    description = {'source': source_digest(path), 'version': MESH_CACHE_VERSION}
+    description.update(params)
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def mesh_content_digest(mesh):
+    """Return a hash of the vertices and faces of a mesh, to cache meshes derived from it"""
+    vertices, faces, _ = mesh_to_arrays(mesh)
+    sha1 = hashlib.sha1()
+    sha1.update(np.ascontiguousarray(vertices).tobytes())
+    sha1.update(np.ascontiguousarray(faces, dtype=np.int64).tobytes())
+    return sha1.hexdigest()
+
+
+def mesh_to_arrays(mesh):
+    """Return the vertices, triangle faces and point normals (or None) of a vedo mesh as NumPy arrays"""
+    poly = mesh.polydata()
+    vertices = np.asarray(mesh.points(), dtype=np.float32)
+    faces = vtk_to_numpy(poly.GetPolys().GetConnectivityArray()).reshape(-1, 3)
+    normals = poly.GetPointData().GetNormals()
+    if normals is not None:
+        normals = vtk_to_numpy(normals)
+    return vertices, faces, normals
+
+
+def arrays_to_mesh(vertices, faces, normals=None):
+    """Build a vedo mesh from vertex, triangle face and optional point normal arrays"""
+    mesh = Mesh([vertices, faces])
+    if normals is not None:
+        mesh.pointdata['Normals'] = normals
+        mesh.polydata().GetPointData().SetActiveNormals('Normals')
+    return mesh
+
+
+# Names of the files written by save_cached_mesh, with or (before versioning) without the
+# cache version; prune_mesh_cache never touches other files of the cache folder
+CACHE_ENTRY_PATTERN = re.compile(r'(?:v(\d+)_)?[0-9a-f]{40}\.npz')
+
+
+def _cache_entry_path(key):
+    # Entries carry the cache version so prune_mesh_cache can drop those of older versions
+    return os.path.join(_mesh_cache_dir, f"v{MESH_CACHE_VERSION}_{key}.npz")
+
+
+def load_cached_mesh(key):
+    """Return the cached mesh for key, or None if it is not in the cache"""
+    if _mesh_cache_dir is None:
+        return None
+    path = _cache_entry_path(key)
+    try:
+        with np.load(path) as cached:
+            normals = cached['normals'] if 'normals' in cached else None
+            mesh = arrays_to_mesh(cached['vertices'], cached['faces'], normals)
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    try:
+        # Mark the entry as recently used for prune_mesh_cache (access times are often not updated)
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+    return mesh
+
+
+def save_cached_mesh(key, mesh):
+    """Store a mesh in the cache as compressed vertex and face arrays"""
+    if _mesh_cache_dir is None:
+        return
+    os.makedirs(_mesh_cache_dir, exist_ok=True)
+    vertices, faces, normals = mesh_to_arrays(mesh)
+    arrays = {'vertices': vertices, 'faces': faces.astype(np.int32)}
+    if normals is not None:
+        arrays['normals'] = normals.astype(np.float32)
+    # Write to a temporary file first so concurrent readers never see a partial entry
+    path = _cache_entry_path(key)
+    tmp_path = f"{path[:-len('.npz')]}.tmp{os.getpid()}.npz"
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    prune_mesh_cache()
+
+
+def _remove_entry(path, size):
+    """Delete a cache entry and return the number of bytes freed"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def prune_mesh_cache(max_bytes=None):
+    """
+    Remove entries of older cache versions, then the least recently used entries until the
+    cache folder fits in max_bytes
+    Args:
+        max_bytes: size limit, None for the budget set by set_mesh_cache_budget
+    Returns:
+        number of bytes removed
+    """
+    if _mesh_cache_dir is None:
+        return 0
+    max_bytes = _mesh_cache_budget if max_bytes is None else max_bytes
+    entries = []
+    stale = []
+    try:
+        with os.scandir(_mesh_cache_dir) as it:
+            for entry in it:
+                match = CACHE_ENTRY_PATTERN.fullmatch(entry.name)
+                if match is None:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if match.group(1) == str(MESH_CACHE_VERSION):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                else:
+                    stale.append((entry.path, stat.st_size))
+    except FileNotFoundError:
+        return 0
+
+    removed = 0
+    for path, size in stale:
+        removed += _remove_entry(path, size)
+    total = sum(size for _, size, _ in entries)
+    # Least recently used entries first
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        removed += _remove_entry(path, size)
+        total -= size
+    return removed
+
+
+def smooth_mesh(mesh, niter=20, method=None, adjacency=None):
+    """
+    Smooth a mesh with the selected engine
+    Args:
+        mesh: vedo mesh, modified in place by the 'vtk' engine
+        niter: number of smoothing iterations
+        method: 'vtk', 'taubin' or 'laplacian', None for the default set by set_smoothing
+        adjacency: vertex_adjacency of the mesh, to reuse it across calls on meshes with the
+                   same faces (built once per call if not given, ignored by the 'vtk' engine)
+    Returns:
+        smoothed vedo mesh
+    """
+    method = method or _smoothing_method
+    if method == 'vtk':
+        return mesh.smooth(niter=niter)
+    if method not in SMOOTHING_METHODS:
+        raise ValueError(f"Unknown smoothing method {method!r}, expected one of {SMOOTHING_METHODS}")
+    vertices, faces, _ = mesh_to_arrays(mesh)
+    if len(faces) == 0:
+        return mesh
+    if adjacency is None:
+        # Shared by every iteration and by both Taubin steps
+        adjacency = vertex_adjacency(faces, len(vertices))
+    smoother = taubin_smooth if method == 'taubin' else laplacian_smooth
+    smoothed = smoother(vertices, faces, niter, adjacency=adjacency)
+    return arrays_to_mesh(smoothed.astype(np.float32), faces, vertex_normals(smoothed, faces).astype(np.float32))
+
+
+def split_isosurfaces(mesh, thresholds):
+    """
+    Split the output of a multi-value isosurface into one mesh per threshold
+    Every point carries the iso value it was interpolated at, so each triangle is
+    assigned to the threshold closest to the value of its first vertex.
+    """
+    vertices, faces, normals = mesh_to_arrays(mesh)
+    values = mesh.pointdata['input_scalars']
+    thresholds = np.asarray(thresholds, dtype=float)
+    face_level = np.abs(values[faces[:, 0], np.newaxis] - thresholds[np.newaxis, :]).argmin(axis=1)
+
+    meshes = []
+    for level in range(len(thresholds)):
+        level_faces = faces[face_level == level]
+        # Keep only the vertices used by this surface and renumber the faces
+        used, new_faces = np.unique(level_faces, return_inverse=True)
+        level_normals = None if normals is None else normals[used]
+        meshes.append(arrays_to_mesh(vertices[used], new_faces.reshape(-1, 3), level_normals))
+    return meshes
+
+
+def crop_to_surface(data, threshold, spacing=(1,1,1)):
+    """
+    Crop a volume to the region where an isosurface at threshold can lie
+    Args:
+        data: 3D NumPy array
+        threshold: lowest iso value that will be extracted
+        spacing: voxel spacing of the volume
+    Returns:
+        (cropped view, origin of the cropped grid), or (None, None) if no voxel is above threshold
+    """
+    box = mask_bounding_box(data, threshold)
+    if box is None:
+        return None, None
+    # One voxel of margin keeps the crossings at the box faces inside the grid
+    box = pad_box(box, data.shape)
+    return data[box_slices(box)], np.multiply(box[0], spacing)
+
+
+def extract_isosurfaces(data, thresholds, spacing=(1,1,1), crop=True):
+    """
+    Extract the isosurfaces of several thresholds with a single contouring call on one VTK grid
+    Args:
+        data: 3D NumPy array
+        thresholds: list of iso values
+        spacing: voxel spacing of the volume
+        crop: contour only the bounding box of the voxels above the lowest threshold
+    Returns:
+        list of unsmoothed vedo meshes, one per threshold
+    """
+    origin = (0, 0, 0)
+    if crop:
+        data, origin = crop_to_surface(data, min(thresholds), spacing)
+        if data is None:
+            empty = (np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int64))
+            return [arrays_to_mesh(*empty) for _ in thresholds]
+
+    if len(thresholds) == 1:
+        vol = Volume(np.ascontiguousarray(data), spacing=spacing, origin=origin)
+        return [vol.isosurface(thresholds[0])]
+    # The contour values are stored in the input type, so integer data is contoured as float32
+    # to keep the iso value of every point for split_isosurfaces
+    dtype = np.float32 if np.issubdtype(data.dtype, np.integer) else data.dtype
+    vol = Volume(np.ascontiguousarray(data, dtype=dtype), spacing=spacing, origin=origin)
+    return split_isosurfaces(vol.isosurface(list(thresholds)), thresholds)
+
+
+def _isosurface_keys(path, thresholds, spacing, niter, normalize, world, smoothing):
+    """Return the cache keys of the isosurfaces built by cached_isosurfaces (None without a cache)"""
+    if _mesh_cache_dir is None:
+        return [None] * len(thresholds)
+    params = {'spacing': None if spacing is None else list(spacing), 'niter': niter, 'normalize': normalize,
+              'world': world, 'resample': _resample_voxel_size, 'smoothing': smoothing}
+    return [mesh_key(path, threshold=threshold, **params) for threshold in thresholds]
+
+
+def find_cached_isosurfaces(path, thresholds, spacing=None, niter=20, normalize=False, world=False, smoothing=None):
+    """
+    Return the isosurfaces cached_isosurfaces would return if all of them are in the cache,
+    without reading the volume
+    Args:
+        same as cached_isosurfaces
+    Returns:
+        list of unstyled vedo meshes in the order of thresholds, or None if any is missing
+    """
+    meshes = []
+    for key in _isosurface_keys(path, thresholds, spacing, niter, normalize, world, smoothing or _smoothing_method):
+        mesh = None if key is None else load_cached_mesh(key)
+        if mesh is None:
+            return None
+        meshes.append(mesh)
+    return meshes
+
+
+def cached_isosurfaces(path, thresholds, spacing=None, niter=20, normalize=False, world=False, smoothing=None):
+    """
+    Return the smoothed isosurfaces of several thresholds of a NIFTI volume
+    Thresholds missing from the cache are extracted together in one contouring pass.
+    Args:
+        path: path to the .nii.gz file
+        thresholds: list of isosurface values
+        spacing: voxel spacing override, None to use the spacing of the NIFTI header
+        niter: number of smoothing iterations
+        normalize: rescale the data to the 0-1 range before extracting the surfaces (body scans)
+        world: place the meshes in scanner coordinates with the NIFTI affine
+        smoothing: smoothing engine, see smooth_mesh
+    Returns:
+        list of unstyled vedo meshes, in the order of thresholds
+    """
+    smoothing = smoothing or _smoothing_method
+    meshes = [None] * len(thresholds)
+    keys = _isosurface_keys(path, thresholds, spacing, niter, normalize, world, smoothing)
+    if _mesh_cache_dir is not None:
+        meshes = [load_cached_mesh(key) for key in keys]
+    missing = [i for i, mesh in enumerate(meshes) if mesh is None]
+    if not missing:
+        return meshes
+
+    img, data, spacing = load_mesh_source(path, spacing)
+    levels = [thresholds[i] for i in missing]
+    if normalize:
+        # Contour the raw data at the thresholds of the 0-1 range instead of normalizing a copy
+        levels = normalized_thresholds(data, levels)
+
+    extracted = extract_isosurfaces(data, levels, spacing)
+    for i, mesh in zip(missing, extracted):
+        mesh = smooth_mesh(mesh, niter, smoothing)
+        if world:
+            mesh = transform_mesh(mesh, voxel_to_world(img))
+        if keys[i] is not None:
+            save_cached_mesh(keys[i], mesh)
+        meshes[i] = mesh
+    return meshes
+
+
+def cached_isosurface(path, threshold, spacing=None, niter=20, normalize=False, world=False, smoothing=None):
+    """
+    Return the smoothed isosurface of a NIFTI volume, generating it only if it is not cached
+    Args:
+        path: path to the .nii.gz file
+        threshold: isosurface value
+        spacing: voxel spacing override, None to use the spacing of the NIFTI header
+        niter: number of smoothing iterations
+        normalize: rescale the data to the 0-1 range before extracting the surface (body scans)
+        world: place the mesh in scanner coordinates with the NIFTI affine
+        smoothing: smoothing engine, see smooth_mesh
+    Returns:
+        unstyled vedo mesh
+    """
+    return cached_isosurfaces(path, [threshold], spacing, niter, normalize, world, smoothing)[0]
+
+
+def lod_pyramid(mesh, levels=LOD_LEVELS):
+    """
+    Build the level-of-detail pyramid of a mesh, reusing cached levels
+    Each level is decimated from the next finer one, and cached under the content hash
+    of the full-resolution mesh.
+    Args:
+        mesh: full-resolution vedo mesh
+        levels: decreasing fractions of triangles to keep, 1 being the mesh itself
+    Returns:
+        list of vedo meshes, one per level
+    """
+    content = mesh_content_digest(mesh) if _mesh_cache_dir is not None else None
+    pyramid = []
+    finer, finer_level = mesh, 1.0
+    for level in levels:
+        if level >= 1:
+            pyramid.append(mesh)
+            continue
+        key = None
+        coarse = None
+        if content is not None:
+            description = {'content': content, 'lod': level, 'version': MESH_CACHE_VERSION}
+            key = hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+            coarse = load_cached_mesh(key)
+        if coarse is None:
+            coarse = finer.clone().decimate(level / finer_level)
+            if key is not None:
+                save_cached_mesh(key, coarse)
+        pyramid.append(coarse)
+        finer, finer_level = coarse, level
+    return pyramid
+
+
+def benchmark_cropping(paths, threshold=0.5, spacing=None):
+    """
+    Print the time and VTK grid memory of isosurface extraction with and without bounding-box cropping
+    Args:
+        paths: segmentation .nii.gz files (e.g. heart and lung masks)
+        threshold: isosurface value
+        spacing: voxel spacing override, None to use the spacing of each NIFTI header
+    """
+    for path in paths:
+        img, data, path_spacing = load_mesh_source(path, spacing)
+
+        start = time.perf_counter()
+        full = extract_isosurfaces(data, [threshold], path_spacing, crop=False)[0]
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cropped = extract_isosurfaces(data, [threshold], path_spacing, crop=True)[0]
+        cropped_time = time.perf_counter() - start
+
+        box = mask_bounding_box(data, threshold)
+        cropped_bytes = 0 if box is None else data[box_slices(pad_box(box, data.shape))].nbytes
+        print(f"{os.path.basename(path)}: {full_time:.3f} s -> {cropped_time:.3f} s "
+              f"({full_time / max(cropped_time, 1e-9):.1f}x), grid {data.nbytes / 1024 ** 2:.1f} MB -> "
+              f"{cropped_bytes / 1024 ** 2:.1f} MB, {full.ncells} / {cropped.ncells} triangles")
+
+
+def benchmark_smoothing(paths, threshold=0.5, niter=20, spacing=None):
+    """
+    Print the time of each smoothing engine on the isosurface of each file, and how much it
+    changes the enclosed volume
+    Args:
+        paths: .nii.gz files (e.g. heart and lung masks)
+        threshold: isosurface value
+        niter: number of smoothing iterations
+        spacing: voxel spacing override, None to use the spacing of each NIFTI header
+    """
+    for path in paths:
+        img, data, path_spacing = load_mesh_source(path, spacing)
+        surface = extract_isosurfaces(data, [threshold], path_spacing)[0]
+        if surface.ncells == 0:
+            print(f"{os.path.basename(path)}: empty surface")
+            continue
+        # The numpy engines share the adjacency of the surface, its time is reported on its own
+        start = time.perf_counter()
+        vertices, faces, _ = mesh_to_arrays(surface)
+        adjacency = vertex_adjacency(faces, len(vertices))
+        results = [f"adjacency {time.perf_counter() - start:.3f} s"]
+        for method in SMOOTHING_METHODS:
+            start = time.perf_counter()
+            smoothed = smooth_mesh(surface.clone(), niter, method, adjacency)
+            elapsed = time.perf_counter() - start
+            results.append(f"{method} {elapsed:.3f} s ({100 * (smoothed.volume() / surface.volume() - 1):+.1f}% volume)")
+        print(f"{os.path.basename(path)} ({surface.ncells} triangles): " + ", ".join(results))
@@ -0,0 +1,276 @@
+import json
+import os
+import struct
+import time
+import numpy as np
+from vedo.colors import get_color
+
+try:
+    from utils.mesh_cache import mesh_to_arrays
+except ImportError:
+    # Running as a script from inside the utils folder
+    from mesh_cache import mesh_to_arrays
+
+# Formats accepted by write_mesh and write_mesh_set; 'multi_stl' is ASCII (about 9 times the
+# size of binary STL and much slower to write) and only meant for tools that need named solids
+MESH_FORMATS = ('stl', 'ply', 'glb', 'multi_stl')
+
+# Number of triangles encoded and written at a time
+CHUNK_TRIANGLES = 1 << 16
+
+_STL_RECORD = np.dtype([('normal', '<f4', 3), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+_PLY_FACE = np.dtype([('count', 'u1'), ('indices', '<i4', 3)])
+
+
+def _face_normals(triangles):
+    """Return the unit normals of an (n, 3, 3) array of triangle corners"""
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    return normals
+
+
+def _chunks(faces, chunk_triangles):
+    for start in range(0, len(faces), chunk_triangles):
+        yield faces[start:start + chunk_triangles]
+
+
+def write_binary_stl(path, parts, chunk_triangles=CHUNK_TRIANGLES):
+    """
+    Write triangle meshes into one binary STL file, a chunk of triangles at a time
+    Several parts are written back to back, so merged files need no merged mesh in memory.
+    Args:
+        path: output .stl file
+        parts: list of (vertices, faces) arrays
+        chunk_triangles: number of triangles encoded per write
+    """
+    count = sum(len(faces) for _, faces in parts)
+    with open(path, 'wb') as f:
+        f.write(b'Binary STL written by MRI-Modeling'.ljust(80, b' '))
+        f.write(struct.pack('<I', count))
+        for vertices, faces in parts:
+            vertices = np.asarray(vertices, dtype=np.float32)
+            for chunk in _chunks(faces, chunk_triangles):
+                records = np.zeros(len(chunk), dtype=_STL_RECORD)
+                records['vertices'] = vertices[chunk]
+                records['normal'] = _face_normals(records['vertices'])
+                f.write(records.tobytes())
+
+
+def write_multi_solid_stl(path, parts, chunk_triangles=CHUNK_TRIANGLES):
+    """
+    Write several named meshes as the solids of one ASCII STL file
+    Binary STL has no solid names, so this is a compatibility format: the file is about 9 times
+    larger than binary STL and takes far longer to write. Prefer 'glb' for named parts.
+    Args:
+        path: output .stl file
+        parts: list of (name, vertices, faces)
+        chunk_triangles: number of triangles formatted per write
+    """
+    facet = ("facet normal {:e} {:e} {:e}\n outer loop\n  vertex {:e} {:e} {:e}\n"
+             "  vertex {:e} {:e} {:e}\n  vertex {:e} {:e} {:e}\n endloop\nendfacet\n")
+    with open(path, 'w') as f:
+        for name, vertices, faces in parts:
+            vertices = np.asarray(vertices, dtype=np.float32)
+            f.write(f"solid {name}\n")
+            for chunk in _chunks(faces, chunk_triangles):
+                triangles = vertices[chunk]
+                rows = np.hstack([_face_normals(triangles), triangles.reshape(-1, 9)])
+                f.write(''.join(facet.format(*row) for row in rows.tolist()))
+            f.write(f"endsolid {name}\n")
+
+
+def write_binary_ply(path, vertices, faces, normals=None, chunk_triangles=CHUNK_TRIANGLES):
+    """
+    Write a triangle mesh as a binary little-endian PLY file with shared vertices
+    Args:
+        path: output .ply file
+        vertices: (n, 3) array of vertex positions
+        faces: (m, 3) integer array of vertex indices
+        normals: optional (n, 3) array of vertex normals
+        chunk_triangles: number of faces encoded per write
+    """
+    properties = ['x', 'y', 'z'] + (['nx', 'ny', 'nz'] if normals is not None else [])
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {len(vertices)}"]
+    header += [f"property float {p}" for p in properties]
+    header += [f"element face {len(faces)}", "property list uchar int vertex_indices", "end_header"]
+    columns = [vertices] if normals is None else [vertices, normals]
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(np.hstack(columns).astype('<f4').tobytes())
+        for chunk in _chunks(faces, chunk_triangles):
+            records = np.empty(len(chunk), dtype=_PLY_FACE)
+            records['count'] = 3
+            records['indices'] = chunk
+            f.write(records.tobytes())
+
+
+def write_glb(path, parts):
+    """
+    Write several named meshes as the nodes of one binary glTF 2.0 (.glb) file
+    Args:
+        path: output .glb file
+        parts: list of (name, vertices, faces, normals or None, rgba color or None)
+    """
+    gltf = {'asset': {'version': '2.0', 'generator': 'MRI-Modeling'}, 'scene': 0, 'scenes': [{'nodes': []}],
+            'nodes': [], 'meshes': [], 'materials': [], 'accessors': [], 'bufferViews': [], 'buffers': []}
+    blobs = []
+    offset = 0
+
+    def add_view(array, target):
+        nonlocal offset
+        gltf['bufferViews'].append({'buffer': 0, 'byteOffset': offset, 'byteLength': array.nbytes, 'target': target})
+        blobs.append(array)
+        offset += array.nbytes
+        return len(gltf['bufferViews']) - 1
+
+    for name, vertices, faces, normals, rgba in parts:
+        if len(faces) == 0:
+            continue
+        vertices = np.ascontiguousarray(vertices, dtype='<f4')
+        attributes = {'POSITION': len(gltf['accessors'])}
+        gltf['accessors'].append({'bufferView': add_view(vertices, 34962), 'componentType': 5126,
+                                  'count': len(vertices), 'type': 'VEC3',
+                                  'min': vertices.min(axis=0).tolist(), 'max': vertices.max(axis=0).tolist()})
+        if normals is not None:
+            attributes['NORMAL'] = len(gltf['accessors'])
+            gltf['accessors'].append({'bufferView': add_view(np.ascontiguousarray(normals, dtype='<f4'), 34962),
+                                      'componentType': 5126, 'count': len(normals), 'type': 'VEC3'})
+        indices = np.ascontiguousarray(faces, dtype='<u4').ravel()
+        gltf['accessors'].append({'bufferView': add_view(indices, 34963), 'componentType': 5125,
+                                  'count': len(indices), 'type': 'SCALAR'})
+        primitive = {'attributes': attributes, 'indices': len(gltf['accessors']) - 1, 'mode': 4}
+        if rgba is not None:
+            primitive['material'] = len(gltf['materials'])
+            gltf['materials'].append({'name': name, 'doubleSided': True,
+                                      'alphaMode': 'BLEND' if rgba[3] < 1 else 'OPAQUE',
+                                      'pbrMetallicRoughness': {'baseColorFactor': [float(c) for c in rgba],
+                                                               'metallicFactor': 0.0, 'roughnessFactor': 0.8}})
+        gltf['meshes'].append({'name': name, 'primitives': [primitive]})
+        gltf['nodes'].append({'name': name, 'mesh': len(gltf['meshes']) - 1})
+        gltf['scenes'][0]['nodes'].append(len(gltf['nodes']) - 1)
+    if offset:
+        gltf['buffers'].append({'byteLength': offset})
+    for key in ('materials', 'buffers', 'bufferViews', 'accessors', 'meshes'):
+        # glTF does not allow empty top-level arrays
+        if not gltf[key]:
+            del gltf[key]
+
+    # Both chunks are padded to 4 bytes, the JSON with spaces and the binary data with zeros
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode()
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+    bin_padding = -offset % 4
+    total = 12 + 8 + len(json_chunk) + (8 + offset + bin_padding if offset else 0)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<4sII', b'glTF', 2, total))
+        f.write(struct.pack('<I4s', len(json_chunk), b'JSON'))
+        f.write(json_chunk)
+        if offset:
+            f.write(struct.pack('<I4s', offset + bin_padding, b'BIN\0'))
+            for blob in blobs:
+                f.write(blob.tobytes())
+            f.write(b'\0' * bin_padding)
+
+
+def _concatenate(parts):
+    """Concatenate (vertices, faces, normals) arrays into one mesh, renumbering the faces"""
+    offsets = np.cumsum([0] + [len(v) for v, _, _ in parts[:-1]])
+    vertices = np.concatenate([v for v, _, _ in parts])
+    faces = np.concatenate([f + offset for (_, f, _), offset in zip(parts, offsets)])
+    normals = None
+    if all(n is not None for _, _, n in parts):
+        normals = np.concatenate([n for _, _, n in parts])
+    return vertices, faces, normals
+
+
+def _rgba(color, alpha):
+    return list(get_color(color)) + [alpha]
+
+
+def _report_file(label, path, start):
+    """Print the size and write time of an output file"""
+    print(f"{label}: {os.path.getsize(path) / 1024 ** 2:.2f} MB in {time.perf_counter() - start:.2f} s ({path})")
+
+
+def write_mesh(mesh, name, fmt='stl', color=None):
+    """
+    Write one vedo mesh
+    Args:
+        mesh: vedo mesh
+        name: output filename without extension
+        fmt: 'stl' (binary), 'ply' (binary), 'glb', or 'multi_stl' (large ASCII STL with one named solid)
+        color: optional (color, alpha) stored in .glb files
+    Returns:
+        path of the written file
+    """
+    if fmt not in MESH_FORMATS:
+        raise ValueError(f"Unknown mesh format {fmt!r}, expected one of {MESH_FORMATS}")
+    vertices, faces, normals = mesh_to_arrays(mesh)
+    label = os.path.basename(name)
+    path = f"{name}.{'stl' if fmt == 'multi_stl' else fmt}"
+    start = time.perf_counter()
+    if fmt == 'stl':
+        write_binary_stl(path, [(vertices, faces)])
+    elif fmt == 'ply':
+        write_binary_ply(path, vertices, faces, normals)
+    elif fmt == 'glb':
+        write_glb(path, [(label, vertices, faces, normals, None if color is None else _rgba(*color))])
+    else:
+        write_multi_solid_stl(path, [(label, vertices, faces)])
+    _report_file(label, path, start)
+    return path
+
+
+def write_mesh_set(meshes, prefix, fmt='stl', combinations=None, colors=None):
+    """
+    Write named meshes either as one file per mesh or as one multi-part file
+    Args:
+        meshes: dict {name: vedo mesh}
+        prefix: output path prefix, files are named {prefix}_{name}.{ext} or {prefix}.{ext}
+        fmt: 'stl' and 'ply' write one file per mesh plus one per combination,
+             'glb' and 'multi_stl' write all meshes as named parts of a single file
+             ('multi_stl' is ASCII, see write_multi_solid_stl)
+        combinations: dict {name: list of mesh names} of merged files written with 'stl' and 'ply'
+        colors: optional dict {name: (color, alpha)} stored in .glb files
+    Returns:
+        list of written files
+    """
+    if fmt not in MESH_FORMATS:
+        raise ValueError(f"Unknown mesh format {fmt!r}, expected one of {MESH_FORMATS}")
+    arrays = {name: mesh_to_arrays(mesh) for name, mesh in meshes.items()}
+    colors = colors or {}
+    written = []
+
+    if fmt in ('glb', 'multi_stl'):
+        path = f"{prefix}.{'glb' if fmt == 'glb' else 'stl'}"
+        start = time.perf_counter()
+        if fmt == 'glb':
+            write_glb(path, [(name, v, f, n, _rgba(*colors[name]) if name in colors else None)
+                             for name, (v, f, n) in arrays.items()])
+        else:
+            write_multi_solid_stl(path, [(name, v, f) for name, (v, f, n) in arrays.items()])
+        _report_file(', '.join(arrays), path, start)
+        return [path]
+
+    for name, (vertices, faces, normals) in arrays.items():
+        path = f"{prefix}_{name}.{fmt}"
+        start = time.perf_counter()
+        if fmt == 'stl':
+            write_binary_stl(path, [(vertices, faces)])
+        else:
+            write_binary_ply(path, vertices, faces, normals)
+        _report_file(name, path, start)
+        written.append(path)
+
+    for name, parts in (combinations or {}).items():
+        path = f"{prefix}_{name}.{fmt}"
+        start = time.perf_counter()
+        if fmt == 'stl':
+            # The parts are streamed one after the other instead of building a merged mesh
+            write_binary_stl(path, [arrays[part][:2] for part in parts])
+        else:
+            vertices, faces, normals = _concatenate([arrays[part] for part in parts])
+            write_binary_ply(path, vertices, faces, normals)
+        _report_file(name, path, start)
+        written.append(path)
+    return written
+
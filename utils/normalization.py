@@ -0,0 +1,44 @@
+import numpy as np
+
+# Size of the slabs scanned by value_range (1 MB), small enough to stay in the CPU cache
+# between the min and the max reduction
+RANGE_SLAB_BYTES = 1024 ** 2
+
+
+def value_range(data, slab_bytes=RANGE_SLAB_BYTES):
+    """
+    Compute the minimum and maximum of an array in one pass over memory
+    Args:
+        data: NumPy array (views and memmaps are read without copying)
+        slab_bytes: approximate size of each slab
+    Returns:
+        (min, max) as Python floats
+    """
+    if data.size == 0:
+        raise ValueError("Cannot compute the value range of an empty array")
+    # Cut the slabs along the slowest-varying axis so each slab is contiguous in memory
+    # (NIFTI data is usually in Fortran order)
+    axis = data.ndim - 1 if data.flags['F_CONTIGUOUS'] and not data.flags['C_CONTIGUOUS'] else 0
+    rows = max(1, slab_bytes // max(1, data.nbytes // data.shape[axis]))
+    lo, hi = np.inf, -np.inf
+    for start in range(0, data.shape[axis], rows):
+        slab = data[(slice(None),) * axis + (slice(start, start + rows),)]
+        lo = min(lo, slab.min())
+        hi = max(hi, slab.max())
+    return float(lo), float(hi)
+
+
+def normalized_thresholds(data, thresholds):
+    """
+    Convert thresholds on the 0-1 normalized volume into thresholds on the raw data
+    Isosurfaces are interpolated linearly, so contouring the raw data at lo + t * (hi - lo)
+    gives the surface of (data - lo) / (hi - lo) at t without building the normalized copy.
+    Args:
+        data: NumPy array of raw intensities
+        thresholds: list of iso values in the 0-1 range
+    Returns:
+        list of iso values in the units of data
+    """
+    lo, hi = value_range(data)
+    return [lo + t * (hi - lo) for t in thresholds]
+
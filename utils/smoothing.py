@@ -0,0 +1,120 @@
+import numpy as np
+
+# Smoothing engines accepted by smooth_mesh
+SMOOTHING_METHODS = ('vtk', 'taubin', 'laplacian')
+
+# Taubin pass band factors: the shrinking step lam is followed by the inflating step mu
+TAUBIN_LAMBDA = 0.5
+TAUBIN_MU = -0.53
+
+
+def vertex_adjacency(faces, n_vertices):
+    """
+    Build the vertex adjacency of a triangle mesh, to be reused across smoothing iterations
+    Neighbours are stored as a padded table with one row per neighbour rank, so each
+    iteration gathers whole columns of vertices instead of scattering edge by edge.
+    Padding entries point at index n_vertices, an extra all-zero vertex.
+    Args:
+        faces: (n, 3) integer array of vertex indices
+        n_vertices: number of vertices of the mesh
+    Returns:
+        (neighbours, degree, fixed): (max degree, n_vertices) neighbour table, the number of
+        neighbours of each vertex, and a boolean mask of the boundary vertices
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    edges.sort(axis=1)
+    # Encode each undirected edge as one integer so np.unique can count them
+    codes, counts = np.unique(edges[:, 0] * n_vertices + edges[:, 1], return_counts=True)
+    lo, hi = np.divmod(codes, n_vertices)
+
+    # Edges used by a single triangle lie on the boundary of an open surface
+    fixed = np.zeros(n_vertices, dtype=bool)
+    fixed[lo[counts == 1]] = True
+    fixed[hi[counts == 1]] = True
+
+    src = np.concatenate([lo, hi])
+    dst = np.concatenate([hi, lo])
+    order = np.argsort(src, kind='stable')
+    src, dst = src[order], dst[order]
+    degree = np.bincount(src, minlength=n_vertices)
+    # Position of each edge among the edges of its source vertex
+    rank = np.arange(len(src)) - np.repeat(np.cumsum(degree) - degree, degree)
+    neighbours = np.full((degree.max() if len(src) else 0, n_vertices), n_vertices, dtype=np.intp)
+    neighbours[rank, src] = dst
+    return neighbours, degree, fixed
+
+
+def _smooth(vertices, faces, factors, niter, adjacency):
+    """Apply niter rounds of umbrella Laplacian steps, one step per factor in each round"""
+    n_vertices = len(vertices)
+    if adjacency is None:
+        adjacency = vertex_adjacency(faces, n_vertices)
+    neighbours, degree, fixed = adjacency
+
+    # Work on a copy with the extra zero vertex used by the padding of the neighbour table
+    points = np.zeros((n_vertices + 1, 3))
+    points[:n_vertices] = vertices
+    inverse_degree = np.zeros((n_vertices + 1, 1))
+    inverse_degree[:n_vertices, 0] = np.where(degree > 0, 1 / np.maximum(degree, 1), 0)
+    # Boundary and isolated vertices do not move
+    movable = np.zeros((n_vertices + 1, 1))
+    movable[:n_vertices, 0] = (degree > 0) & ~fixed
+
+    neighbour_sum = np.empty_like(points)
+    gathered = np.empty_like(points)
+    # mode='clip' lets np.take write straight into out=, indices are always in range
+    for _ in range(niter):
+        for factor in factors:
+            neighbour_sum.fill(0)
+            for column in neighbours:
+                np.take(points, column, axis=0, out=gathered[:n_vertices], mode='clip')
+                neighbour_sum[:n_vertices] += gathered[:n_vertices]
+            neighbour_sum *= inverse_degree
+            neighbour_sum -= points
+            neighbour_sum *= movable
+            points += factor * neighbour_sum
+    return points[:n_vertices]
+
+
+def laplacian_smooth(vertices, faces, niter=20, factor=0.5, adjacency=None):
+    """
+    Smooth a triangle mesh with the umbrella Laplacian operator, boundary vertices stay fixed
+    Args:
+        vertices: (n, 3) array of vertex positions
+        faces: (m, 3) integer array of vertex indices
+        niter: number of iterations
+        factor: fraction of the way each vertex moves towards its neighbours per iteration
+        adjacency: result of vertex_adjacency, computed if not given
+    Returns:
+        float64 array of the smoothed vertex positions
+    """
+    return _smooth(vertices, faces, (factor,), niter, adjacency)
+
+
+def taubin_smooth(vertices, faces, niter=20, lam=TAUBIN_LAMBDA, mu=TAUBIN_MU, adjacency=None):
+    """
+    Smooth a triangle mesh with Taubin's lambda/mu filter, which does not shrink the surface
+    Args:
+        vertices: (n, 3) array of vertex positions
+        faces: (m, 3) integer array of vertex indices
+        niter: number of lambda/mu iteration pairs
+        lam: positive smoothing factor
+        mu: negative inflating factor, slightly larger in magnitude than lam
+        adjacency: result of vertex_adjacency, computed if not given
+    Returns:
+        float64 array of the smoothed vertex positions
+    """
+    return _smooth(vertices, faces, (lam, mu), niter, adjacency)
+
+
+def vertex_normals(vertices, faces):
+    """Return the area-weighted unit normals of the vertices of a triangle mesh"""
+    a, b, c = (vertices[faces[:, i]] for i in range(3))
+    face_normals = np.cross(b - a, c - a)
+    normals = np.empty_like(vertices)
+    for axis in range(3):
+        normals[:, axis] = np.bincount(faces.ravel(), weights=np.repeat(face_normals[:, axis], 3),
+                                       minlength=len(vertices))
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+    return normals
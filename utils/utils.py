@@ -2,7 +2,7 @@ from vedo import show, Volume
 import nibabel as nib
 import matplotlib.pyplot as plt
 
-def visualize_mri_3d(data, filename, slice=0, timeseries=True, bg='white'):
+def visualize_mri_3d(data, filename, slice=0, timeseries=True, bg='white', spacing=(1,1,3)):
     """
     Visualize 3D MRI data using interactive volume rendering.
     This function creates a 3D visualization of MRI data using the Volume renderer.
@@ -20,10 +20,13 @@ def visualize_mri_3d(data, filename, slice=0, timeseries=True, bg='white'):
         If False, visualizes first timepoint of all slices (default is True)
     bg : str, optional
         Background color for visualization (default is 'black')
+    spacing : tuple, optional
+        Voxel size of the spatial axes, usually img.header.get_zooms() (default is (1,1,3))
     """
+    spacing = tuple(spacing[:3])
     if len(data.shape) == 3:
         title = f'{filename}'
-        vol = Volume(data, spacing=xyzspacing)
+        vol = Volume(data, spacing=spacing)
     else:
         if timeseries is False:
             timepoint = int(input(f"Enter the timepoint (0-{data.shape[3]-1}): "))
@@ -31,10 +34,11 @@ def visualize_mri_3d(data, filename, slice=0, timeseries=True, bg='white'):
                 print(f"Invalid timepoint. Please enter a number between 0 and {data.shape[3]-1}")
                 timepoint = input(f"Enter the timepoint (0-{data.shape[3]-1}): ")
             title = f'{filename} All Slice at Time {timepoint}'
-            vol = Volume(data[:,:,:,timepoint], spacing=(1,1,3))
+            vol = Volume(data[:,:,:,timepoint], spacing=spacing)
         else:
             title = f'{filename} Slice {slice}'
-            vol = Volume(data[:,:,slice,:], spacing=(1,1,3))
+            # The third axis is time here, only the in-plane spacing comes from the header
+            vol = Volume(data[:,:,slice,:], spacing=(spacing[0], spacing[1], 3))
     
     show(vol, bg=bg, title=title)
 
@@ -168,6 +172,6 @@ if __name__ == "__main__":
     if option == 1:
         visualize_mri(data, filename, slice, timeseries)
     elif option == 2:
-        visualize_mri_3d(data, filename, slice, timeseries)
+        visualize_mri_3d(data, filename, slice, timeseries, spacing=xyzspacing)
     elif option == 3:
         extract_and_save_3d_slice(data, filename, slice)
\ No newline at end of file
@@ -1,75 +1,462 @@
-from vedo import Volume, Plotter, Text2D, merge
-import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import os
+import time
+from nibabel.filebasedimages import ImageFileError
+from vedo import Plotter, Text2D
+import numpy as np
+from utils.normalization import normalized_thresholds
+from utils.mesh_cache import (cached_isosurface, cached_isosurfaces, find_cached_isosurfaces, extract_isosurfaces,
+                              lod_pyramid, LOD_LEVELS, load_mesh_source, mesh_to_arrays, arrays_to_mesh, smooth_mesh)
+from utils.mesh_writer import write_mesh, write_mesh_set
+from utils.decimation import plan_decimation, triangle_count
 
-def visualize_skin(volume_path):
+# Largest mesh rendered at full resolution while the camera is moving
+INTERACTIVE_TRIANGLES = 200000
+
+# Downsampling factor of the volumes used for the progressive preview
+PREVIEW_FACTOR = 4
+
+# Color and opacity of each organ in the skin, bone, heart and lung view
+ORGAN_STYLES = {'skin': ('wheat', 0.3), 'bone': ('ivory', 1), 'heart': ('red', 1), 'lung': ('pink', 1)}
+
+def _report(progress, message):
+    """Send a progress message to the optional progress callback"""
+    if progress is not None:
+        progress(message)
+
+def _timed_surfaces(path, thresholds, normalize):
+    """Build the surfaces of one organ task and return them with the time it took"""
+    start = time.perf_counter()
+    return cached_isosurfaces(path, thresholds, normalize=normalize), time.perf_counter() - start
+
+def _surface_task(path, thresholds, normalize):
+    """Worker side of build_surfaces, returns the surfaces as arrays so they can be sent back"""
+    meshes, elapsed = _timed_surfaces(path, thresholds, normalize)
+    return [mesh_to_arrays(mesh) for mesh in meshes], elapsed
+
+def organ_tasks(volume_path=None, heart=None, lung=None, bone=True):
     """
-    Create a 3D visualization of the body outline using Plotter
+    List the surface builds of the organs whose files are given, for build_surfaces
+    Skin (0.1) and bone (0.75) are extracted from the normalized body volume in one pass.
+    Returns:
+        list of (organ names, path, thresholds, normalize) tuples
+    """
+    tasks = []
+    if volume_path is not None:
+        if bone:
+            tasks.append((('skin', 'bone'), volume_path, [0.1, 0.75], True))
+        else:
+            tasks.append((('skin',), volume_path, [0.1], True))
+    if heart is not None:
+        tasks.append((('heart',), heart, [0.5], False))
+    if lung is not None:
+        tasks.append((('lung',), lung, [0.5], False))
+    return tasks
+
+def build_surfaces(tasks, workers=None, progress=None):
+    """
+    Build independent organ surfaces and print how long each one took
+    By default the organs are built concurrently in threads of this process, where they share
+    the volume cache and nothing has to be sent between processes (decompression, contouring
+    and the numpy smoothing release the GIL); command line runs can ask for a process pool.
+    Args:
+        tasks: list of (organ names, path, thresholds, normalize) tuples from organ_tasks
+        workers: None to build the tasks in one thread each, 1 to build them one after the
+                 other (e.g. inside a batch worker process), more for that many worker processes
+        progress: optional callback receiving a message when each organ is done
+    Returns:
+        dict of unstyled vedo meshes keyed by organ name
+    """
+    meshes = {}
+
+    def collect(names, surfaces, elapsed):
+        label = ' and '.join(names)
+        print(f"Built {label} in {elapsed:.2f} s")
+        _report(progress, f"Built {label} surface")
+        meshes.update(zip(names, surfaces))
+
+    if workers == 1 or len(tasks) <= 1:
+        for names, path, thresholds, normalize in tasks:
+            _report(progress, f"Building {' and '.join(names)} surface")
+            collect(names, *_timed_surfaces(path, thresholds, normalize))
+        return meshes
+
+    if workers is None:
+        with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+            futures = {pool.submit(_timed_surfaces, path, thresholds, normalize): names
+                       for names, path, thresholds, normalize in tasks}
+            _report(progress, f"Building {len(futures)} surfaces in parallel")
+            for future in as_completed(futures):
+                collect(futures[future], *future.result())
+        return meshes
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        futures = {pool.submit(_surface_task, path, thresholds, normalize): names
+                   for names, path, thresholds, normalize in tasks}
+        _report(progress, f"Building {len(futures)} surfaces in parallel")
+        for future in as_completed(futures):
+            arrays, elapsed = future.result()
+            collect(futures[future], [arrays_to_mesh(*a) for a in arrays], elapsed)
+    return meshes
+
+def build_skin_meshes(volume_path, progress=None):
+    """
+    Create the body outline mesh shown by visualize_skin
     Args:
         volume_path: path to the .nii.gz file
+        progress: optional callback receiving a message before each stage
+    Returns:
+        list of styled vedo meshes
     """
-    # Load the volume
-    img = nib.load(volume_path)
-    data = img.get_fdata()
-    
-    # Normalize the data to 0-1 range
-    data = (data - data.min()) / (data.max() - data.min())
-    
-    # Create volume with appropriate spacing
-    vol = Volume(data, spacing=(1,1,3))
-    
-    # Create isosurface mesh
-    mesh = vol.isosurface(0.1) # 0.1 is the threshold value for showing the skin
-    mesh.smooth(niter=20)
+    # 0.1 is the threshold value for showing the skin on the normalized volume
+    _report(progress, "Building skin surface")
+    mesh = cached_isosurface(volume_path, 0.1, normalize=True)
     mesh.color('wheat')
     mesh.alpha(0.9)
-    
-    # Create plotter instance with proper lighting
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D("MRI Visualization", pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([mesh, txt])
-    
-    # Set camera position
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
-    
-    # Show the visualization with default lighting
-    plt.show(interactive=True)
-    
+    return [mesh]
 
-def visualize_bone(volume_path):
+def build_bone_meshes(volume_path, progress=None):
     """
-    Create a 3D visualization of the body outline using Plotter
+    Create the bone mesh shown by visualize_bone
     Args:
         volume_path: path to the .nii.gz file
+        progress: optional callback receiving a message before each stage
+    Returns:
+        list of styled vedo meshes
     """
-    # Load the volume
-    img = nib.load(volume_path)
-    data = img.get_fdata()
-    
-    # Normalize the data to 0-1 range
-    data = (data - data.min()) / (data.max() - data.min())
-    
-    # Create volume with appropriate spacing
-    vol = Volume(data, spacing=(1,1,3))
-    
-    # Create isosurface mesh
-    mesh = vol.isosurface(0.75) # 0.75 is the threshold value for showing the bones
-    mesh.smooth(niter=20)
+    # 0.75 is the threshold value for showing the bones on the normalized volume
+    _report(progress, "Building bone surface")
+    mesh = cached_isosurface(volume_path, 0.75, normalize=True)
     mesh.color('wheat')
     mesh.alpha(0.9)
+    return [mesh]
+
+def build_heart_lung_meshes(heart_path, lung_path, progress=None, workers=None):
+    """
+    Create the heart and lung meshes shown by visualize_heart_lung
+    Args:
+        heart_path: path to the heart segmentation .nii.gz file
+        lung_path: path to the lung segmentation .nii.gz file
+        progress: optional callback receiving a message before each stage
+        workers: how the organs are built in parallel, see build_surfaces
+    Returns:
+        list of styled vedo meshes
+    """
+    meshes = build_surfaces(organ_tasks(heart=heart_path, lung=lung_path), workers, progress)
+    heart_mesh, lung_mesh = meshes['heart'], meshes['lung']
     
+    # Apply styling
+    heart_mesh.color('red').alpha(0.8)
+    lung_mesh.color('pink').alpha(0.6)
+    return [heart_mesh, lung_mesh]
+
+def build_skin_heart_lung_meshes(volume_path, heart_path, lung_path, progress=None, workers=None):
+    """
+    Create the body outline, heart and lung meshes shown by visualize_skin_heart_lung
+    Args:
+        volume_path: path to the body volume .nii.gz file
+        heart_path: path to the heart segmentation .nii.gz file
+        lung_path: path to the lung segmentation .nii.gz file
+        progress: optional callback receiving a message before each stage
+        workers: how the organs are built in parallel, see build_surfaces
+    Returns:
+        list of styled vedo meshes
+    """
+    meshes = build_surfaces(organ_tasks(volume_path, heart_path, lung_path, bone=False), workers, progress)
+    skin_mesh, heart_mesh, lung_mesh = meshes['skin'], meshes['heart'], meshes['lung']
+    
+    # Apply styling
+    skin_mesh.color('wheat').alpha(0.3)
+    heart_mesh.color('red').alpha(0.8)
+    lung_mesh.color('pink').alpha(0.6)
+    return [skin_mesh, heart_mesh, lung_mesh]
+
+def build_skin_bone_heart_lung_meshes(volume_path, heart, lung, progress=None, workers=None):
+    """
+    Create the body outline, bone, heart and lung meshes shown by visualize_skin_bone_heart_lung
+    Args:
+        volume_path: path to the body volume .nii.gz file
+        heart: path to the heart segmentation .nii.gz file
+        lung: path to the lung segmentation .nii.gz file
+        progress: optional callback receiving a message before each stage
+        workers: how the organs are built in parallel, see build_surfaces
+    Returns:
+        list of styled vedo meshes
+    """
+    meshes = build_organ_meshes(volume_path, heart, lung, progress, workers)
+    
+    # Apply styling
+    for name, (color, alpha) in ORGAN_STYLES.items():
+        meshes[name].color(color).alpha(alpha)
+    return [meshes[name] for name in ORGAN_STYLES]
+
+def build_preview_meshes(volume_path, heart, lung, factor=PREVIEW_FACTOR, progress=None):
+    """
+    Create coarse skin, bone, heart and lung meshes from volumes downsampled by factor,
+    shown by show_progressive while the full-resolution meshes are built
+    When every full-resolution mesh is already in the mesh cache, those are returned instead
+    (with their levels of detail) and no volume is read.
+    Args:
+        volume_path: path to the body volume .nii.gz file
+        heart: path to the heart segmentation .nii.gz file
+        lung: path to the lung segmentation .nii.gz file
+        factor: keep every factor-th voxel along each axis
+        progress: optional callback receiving a message before each stage
+    Returns:
+        dict of styled vedo meshes keyed by 'skin', 'bone', 'heart' and 'lung'; preview
+        meshes have mesh.info['preview'] set
+    """
+    _report(progress, "Looking up cached meshes")
+    meshes = {}
+    for names, path, thresholds, normalize in organ_tasks(volume_path, heart, lung):
+        surfaces = find_cached_isosurfaces(path, thresholds, normalize=normalize)
+        if surfaces is None:
+            break
+        meshes.update(zip(names, surfaces))
+    else:
+        for name, (color, alpha) in ORGAN_STYLES.items():
+            meshes[name].color(color).alpha(alpha)
+        prepare_lod(meshes.values(), progress=progress)
+        return meshes
+
+    # Every factor-th voxel keeps its position when the spacing grows by the same factor
+    step = (slice(None, None, factor),) * 3
+
+    _report(progress, "Building preview of skin and bone")
+    img, data, spacing = load_mesh_source(volume_path)
+    # Thresholds come from the range of the full volume so the preview matches the final surfaces
+    skin_bone_levels = normalized_thresholds(data, [0.1, 0.75])
+    skin_mesh, bone_mesh = extract_isosurfaces(data[step], skin_bone_levels, np.multiply(spacing, factor))
+    meshes = {'skin': skin_mesh, 'bone': bone_mesh}
+    for name, path in (('heart', heart), ('lung', lung)):
+        _report(progress, f"Building preview of {name}")
+        img, data, spacing = load_mesh_source(path)
+        meshes[name] = extract_isosurfaces(data[step], [0.5], np.multiply(spacing, factor))[0]
+
+    for name, (color, alpha) in ORGAN_STYLES.items():
+        meshes[name] = smooth_mesh(meshes[name], niter=5).color(color).alpha(alpha)
+        meshes[name].info['preview'] = True
+    return meshes
+
+# Idle time after the last camera interaction before full resolution is rendered again (ms)
+LOD_RESTORE_DELAY = 300
+
+def _interactive_level(pyramid, max_triangles=INTERACTIVE_TRIANGLES):
+    """Return the finest level of a LOD pyramid with at most max_triangles triangles"""
+    for mesh in pyramid:
+        if triangle_count(mesh) <= max_triangles:
+            return mesh
+    return pyramid[-1]
+
+def prepare_lod(meshes, levels=LOD_LEVELS, progress=None):
+    """
+    Build the coarse level rendered during interaction for every mesh too large to move
+    smoothly, and keep it with the mesh for attach_lod_switching
+    Runs before the window opens (e.g. on the GUI worker thread), so showing the meshes
+    does not wait for decimation.
+    Args:
+        meshes: list of vedo meshes
+        levels: LOD fractions built for each mesh
+        progress: optional callback receiving a message before each mesh
+    Returns:
+        the same meshes
+    """
+    for mesh in meshes:
+        if triangle_count(mesh) > INTERACTIVE_TRIANGLES and 'lod' not in mesh.info:
+            _report(progress, "Building levels of detail")
+            mesh.info['lod'] = _interactive_level(lod_pyramid(mesh, levels))
+    return meshes
+
+def build_with_lod(build, *args, progress=None, **kwargs):
+    """Call one of the build_*_meshes functions and prepare the levels of detail of its meshes"""
+    return prepare_lod(build(*args, progress=progress, **kwargs), progress=progress)
+
+def attach_lod_switching(plt, meshes, levels=LOD_LEVELS):
+    """
+    Render coarse LOD levels while the camera moves (mouse drags, wheel zoom, keys) and
+    switch back to full resolution once it has been still for LOD_RESTORE_DELAY ms
+    Args:
+        plt: vedo Plotter with an interactor
+        meshes: full-resolution meshes added to the plotter
+        levels: LOD fractions built for meshes that prepare_lod has not seen
+    """
+    if plt.interactor is None:
+        return
+    swaps = []
+    for mesh in prepare_lod(meshes, levels):
+        if 'lod' in mesh.info:
+            swaps.append((mesh.mapper(), mesh.polydata(), mesh.info['lod'].polydata()))
+    if not swaps:
+        return
+    interactor = plt.interactor
+    restore = {'timer': None}
+
+    def use_coarse(obj, event):
+        if restore['timer'] is not None:
+            interactor.DestroyTimer(restore['timer'])
+            restore['timer'] = None
+        for mapper, full_poly, coarse_poly in swaps:
+            mapper.SetInputData(coarse_poly)
+
+    def schedule_full(obj, event):
+        # A wheel step or key press is a complete interaction on its own, waiting before the
+        # full-resolution render keeps a series of them on the coarse level
+        if restore['timer'] is not None:
+            interactor.DestroyTimer(restore['timer'])
+        restore['timer'] = interactor.CreateOneShotTimer(LOD_RESTORE_DELAY)
+
+    def use_full(obj, event):
+        if restore['timer'] is None or interactor.GetTimerEventId() != restore['timer']:
+            return
+        restore['timer'] = None
+        for mapper, full_poly, coarse_poly in swaps:
+            mapper.SetInputData(full_poly)
+        interactor.Render()
+
+    style = interactor.GetInteractorStyle()
+    style.AddObserver('StartInteractionEvent', use_coarse)
+    style.AddObserver('EndInteractionEvent', schedule_full)
+    interactor.AddObserver('KeyPressEvent', use_coarse)
+    interactor.AddObserver('KeyReleaseEvent', schedule_full)
+    interactor.AddObserver('TimerEvent', use_full)
+
+def show_meshes(meshes, title="MRI Visualization", azimuth=0, lod=True):
+    """
+    Show meshes in an interactive Plotter window (must run on the main thread)
+    Args:
+        meshes: list of vedo meshes
+        title: text shown at the top of the window
+        azimuth: camera azimuth in degrees
+        lod: render coarse levels of detail while the camera is moving
+    """
     # Create plotter instance with proper lighting
     plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D("MRI Visualization", pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([mesh, txt])
+    txt = Text2D(title, pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
+    plt.add(list(meshes) + [txt])
+    if lod:
+        attach_lod_switching(plt, meshes)
     
     # Set camera position
     plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
+    plt.camera.Azimuth(azimuth)
     
     # Show the visualization with default lighting
     plt.show(interactive=True)
-    
+
+def show_progressive(preview, volume_path, heart, lung, title="MRI Visualization", azimuth=90):
+    """
+    Show preview meshes right away and replace them with full-resolution meshes as
+    background threads finish each organ (must run on the main thread); meshes that are
+    not previews (found in the mesh cache) are shown as they are
+    The full-resolution build runs in this process, so it reuses the volumes that
+    build_preview_meshes already decoded into the volume cache.
+    Args:
+        preview: dict of styled meshes returned by build_preview_meshes
+        volume_path: path to the body volume .nii.gz file
+        heart: path to the heart segmentation .nii.gz file
+        lung: path to the lung segmentation .nii.gz file
+        title: text shown at the top of the window
+        azimuth: camera azimuth in degrees
+    """
+    plt = Plotter(bg='black', size=(1000, 800), axes=1)
+    txt = Text2D(title, pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
+    shown = dict(preview)
+    plt.add(list(shown.values()) + [txt])
+    # Meshes found in the mesh cache are already at full resolution
+    attach_lod_switching(plt, [mesh for mesh in shown.values() if not mesh.info.get('preview')])
+    plt.camera.Elevation(-90)
+    plt.camera.Azimuth(azimuth)
+
+    def build(path, thresholds, normalize):
+        meshes, elapsed = _timed_surfaces(path, thresholds, normalize)
+        return prepare_lod(meshes), elapsed
+
+    # Each organ and its levels of detail are built in their own thread, like build_surfaces,
+    # while the main thread keeps the window responsive
+    tasks = [task for task in organ_tasks(volume_path, heart, lung)
+             if any(shown[name].info.get('preview') for name in task[0])]
+    pool = ThreadPoolExecutor(max_workers=max(len(tasks), 1))
+    pending = {pool.submit(build, path, thresholds, normalize): names
+               for names, path, thresholds, normalize in tasks}
+
+    def swap_in(future):
+        names = pending.pop(future)
+        try:
+            surfaces, elapsed = future.result()
+        except (FileNotFoundError, ImageFileError) as e:
+            print(f"Failed to build {' and '.join(names)}: {e}")
+            return
+        print(f"Built {' and '.join(names)} in {elapsed:.2f} s")
+        for name, mesh in zip(names, surfaces):
+            color, alpha = ORGAN_STYLES[name]
+            mesh.color(color).alpha(alpha)
+            plt.remove(shown[name])
+            plt.add(mesh)
+            shown[name] = mesh
+            attach_lod_switching(plt, [mesh])
+
+    if plt.interactor is None:
+        # Offscreen plotters have no event loop, so wait for the full-resolution meshes
+        for future in as_completed(list(pending)):
+            swap_in(future)
+        pool.shutdown()
+        plt.show(interactive=False)
+        return plt
+
+    timer = {}
+
+    def poll(event):
+        for future in [f for f in pending if f.done()]:
+            swap_in(future)
+        plt.render()
+        if not pending:
+            plt.timer_callback('stop', timer['id'])
+
+    plt.add_callback('timer', poll)
+    timer['id'] = plt.timer_callback('start', dt=200)
+    plt.show(interactive=True)
+
+    # The window was closed before every organ was ready
+    for future in pending:
+        future.cancel()
+    pool.shutdown(wait=False)
+    return plt
+
+def render_to_file(meshes, path, title="MRI Visualization", azimuth=0, size=(1000, 800)):
+    """
+    Render meshes offscreen with the camera of show_meshes and save a screenshot
+    Args:
+        meshes: list of styled vedo meshes
+        path: output image file (.png)
+        title: text shown at the top of the image
+        azimuth: camera azimuth in degrees
+        size: image size in pixels
+    """
+    plt = Plotter(bg='black', size=size, axes=1, offscreen=True)
+    txt = Text2D(title, pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
+    plt.add(list(meshes) + [txt])
+    plt.camera.Elevation(-90)
+    plt.camera.Azimuth(azimuth)
+    plt.show(interactive=False)
+    plt.screenshot(path)
+    plt.close()
+    return path
+
+def visualize_skin(volume_path):
+    """
+    Create a 3D visualization of the body outline using Plotter
+    Args:
+        volume_path: path to the .nii.gz file
+    """
+    show_meshes(build_skin_meshes(volume_path))
+
+def visualize_bone(volume_path):
+    """
+    Create a 3D visualization of the bones using Plotter
+    Args:
+        volume_path: path to the .nii.gz file
+    """
+    show_meshes(build_bone_meshes(volume_path))
 
 def visualize_heart_lung(heart_path, lung_path):
     """
@@ -78,36 +465,7 @@ def visualize_heart_lung(heart_path, lung_path):
         heart_path: path to the heart segmentation .nii.gz file
         lung_path: path to the lung segmentation .nii.gz file
     """
-    # Load the volumes
-    heart_img = nib.load(heart_path)
-    lung_img = nib.load(lung_path)
-    
-    # Get data
-    heart_data = heart_img.get_fdata()
-    lung_data = lung_img.get_fdata()
-    
-    # Create volumes
-    heart_vol = Volume(heart_data, spacing=(1,1,3))
-    lung_vol = Volume(lung_data, spacing=(1,1,3))
-    
-    # Create meshes
-    heart_mesh = heart_vol.isosurface(0.5)
-    lung_mesh = lung_vol.isosurface(0.5)
-    
-    # Apply styling
-    heart_mesh.smooth(niter=20).color('red').alpha(0.8)
-    lung_mesh.smooth(niter=20).color('pink').alpha(0.6)
-    
-    # Create plotter
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D("MRI Visualization", pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([heart_mesh, lung_mesh, txt])
-    
-    # Set camera
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
-    
-    plt.show(interactive=True)
+    show_meshes(build_heart_lung_meshes(heart_path, lung_path))
 
 def visualize_skin_heart_lung(volume_path, heart_path, lung_path):
     """
@@ -117,43 +475,7 @@ def visualize_skin_heart_lung(volume_path, heart_path, lung_path):
         heart_path: path to the heart segmentation .nii.gz file
         lung_path: path to the lung segmentation .nii.gz file
     """
-    # Load the volumes
-    skin_img = nib.load(volume_path)
-    heart_img = nib.load(heart_path)
-    lung_img = nib.load(lung_path)
-    
-    # Get data and normalize
-    skin_data = skin_img.get_fdata()
-    skin_data = (skin_data - skin_data.min()) / (skin_data.max() - skin_data.min())
-    
-    heart_data = heart_img.get_fdata()
-    lung_data = lung_img.get_fdata()
-    
-    # Create volumes
-    skin_vol = Volume(skin_data, spacing=(1,1,3))
-    heart_vol = Volume(heart_data, spacing=(1,1,3))
-    lung_vol = Volume(lung_data, spacing=(1,1,3))
-    
-    # Create meshes
-    skin_mesh = skin_vol.isosurface(0.1)
-    heart_mesh = heart_vol.isosurface(0.5)
-    lung_mesh = lung_vol.isosurface(0.5)
-    
-    # Apply styling
-    skin_mesh.smooth(niter=20).color('wheat').alpha(0.3)
-    heart_mesh.smooth(niter=20).color('red').alpha(0.8)
-    lung_mesh.smooth(niter=20).color('pink').alpha(0.6)
-    
-    # Create plotter
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D("MRI Visualization", pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([skin_mesh, heart_mesh, lung_mesh, txt])
-    
-    # Set camera
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
-    
-    plt.show(interactive=True)
+    show_meshes(build_skin_heart_lung_meshes(volume_path, heart_path, lung_path))
 
 def visualize_skin_bone_heart_lung(volume_path, heart, lung):
     """
@@ -163,110 +485,223 @@ def visualize_skin_bone_heart_lung(volume_path, heart, lung):
         heart: path to the heart segmentation .nii.gz file
         lung: path to the lung segmentation .nii.gz file
     """
-    # Load the volumes
-    skin_img = nib.load(volume_path)
-    heart_img = nib.load(heart)
-    lung_img = nib.load(lung)
-    
-    # Get data and normalize
-    skin_data = skin_img.get_fdata()
-    skin_data = (skin_data - skin_data.min()) / (skin_data.max() - skin_data.min())
-    
-    heart_data = heart_img.get_fdata()
-    lung_data = lung_img.get_fdata()
-    
-    # Create volumes
-    skin_vol = Volume(skin_data, spacing=(1,1,3))
-    heart_vol = Volume(heart_data, spacing=(1,1,3))
-    lung_vol = Volume(lung_data, spacing=(1,1,3))
-    
-    # Create meshes
-    skin_mesh = skin_vol.isosurface(0.1)
-    bone_mesh = skin_vol.isosurface(0.75)
-    heart_mesh = heart_vol.isosurface(0.5)
-    lung_mesh = lung_vol.isosurface(0.5)
-    
-    # Apply styling
-    skin_mesh.smooth(niter=20).color('wheat').alpha(0.3)
-    bone_mesh.smooth(niter=20).color('ivory').alpha(1)
-    heart_mesh.smooth(niter=20).color('red').alpha(1)
-    lung_mesh.smooth(niter=20).color('pink').alpha(1)
-    
-    # Create plotter
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D("MRI Visualization", pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([skin_mesh, bone_mesh, heart_mesh, lung_mesh, txt])
-    
-    # Set camera
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
+    show_meshes(build_skin_bone_heart_lung_meshes(volume_path, heart, lung))
 
-    plt.show(interactive=True)  
-
-def save_mesh_to_stl(mesh, name, decimation_factor):
+def save_mesh_to_stl(mesh, name, decimation_factor, fmt='stl'):
     """
     Save a mesh to STL file with decimation
     Args:
-        mesh: vedo mesh object
+        mesh: vedo mesh object (left unchanged)
         name: output filename (without extension)
         decimation_factor: factor to reduce the number of triangles (0-1)
+        fmt: output format, 'stl' (binary), 'ply', 'glb' or 'multi_stl', see mesh_writer.write_mesh
     """
-    # Decimate the mesh to reduce polygon count
-    decimated_mesh = mesh.decimate(decimation_factor)
-    decimated_mesh.write(f'{name}.stl')
+    # Decimate a copy of the mesh to reduce polygon count, decimate() works in place
+    decimated_mesh = mesh.clone().decimate(decimation_factor)
+    return write_mesh(decimated_mesh, name, fmt)
 
-def export_stl(filename, volume_path, heart, lung, output_dir, decimation_factor=1,):
+def build_organ_meshes(volume_path, heart, lung, progress=None, workers=None):
     """
-    Create and export 3D meshes of the body outline, bones, heart, and lungs as STL files
+    Create the smoothed skin, bone, heart and lung meshes used for STL export
     Args:
         volume_path: path to the body volume .nii.gz file
         heart: path to the heart segmentation .nii.gz file
         lung: path to the lung segmentation .nii.gz file
+        progress: optional callback receiving a message before each stage
+        workers: how the organs are built in parallel, see build_surfaces
+    Returns:
+        dict of vedo meshes keyed by 'skin', 'bone', 'heart' and 'lung'
+    """
+    return build_surfaces(organ_tasks(volume_path, heart, lung), workers, progress)
+
+def write_stl_set(meshes, filename, output_dir, decimation_factor=1, progress=None, fmt='stl'):
+    """
+    Save the organ meshes and their combinations as STL files in output_dir/filename
+    Args:
+        meshes: dict returned by build_organ_meshes
+        filename: name of the output folder and prefix of the STL files
         output_dir: directory to save STL files
-        decimation_factor: factor to reduce the number of triangles (0-1)
+        decimation_factor: factor to reduce the number of triangles (0-1), or a dict
+                           {organ: factor} such as the one returned by plan_decimation
+        progress: optional callback receiving a message before each stage
+        fmt: 'stl' (binary) or 'ply' write one file per organ and per combination,
+             'glb' or 'multi_stl' write every organ as a named part of a single file
     """
-    # Load the volumes
-    skin_img = nib.load(volume_path)
-    heart_img = nib.load(heart)
-    lung_img = nib.load(lung)
-    
-    # Get data and normalize
-    skin_data = skin_img.get_fdata()
-    skin_data = (skin_data - skin_data.min()) / (skin_data.max() - skin_data.min())
-    
-    heart_data = heart_img.get_fdata()
-    lung_data = lung_img.get_fdata()
-    
-    # Create volumes
-    skin_vol = Volume(skin_data, spacing=(1,1,3))
-    heart_vol = Volume(heart_data, spacing=(1,1,3))
-    lung_vol = Volume(lung_data, spacing=(1,1,3))
-    
-    # Create meshes
-    skin_mesh = skin_vol.isosurface(0.1)
-    bone_mesh = skin_vol.isosurface(0.75)
-    heart_mesh = heart_vol.isosurface(0.5)
-    lung_mesh = lung_vol.isosurface(0.5)
-    
-    # Apply smoothing and decimation
-    skin_mesh.smooth(niter=20)
-    bone_mesh.smooth(niter=20)
-    heart_mesh.smooth(niter=20)
-    lung_mesh.smooth(niter=20)
-    
     # Create output directory if it doesn't exist
-    import os
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Save meshes as STL
     os.makedirs(f'{output_dir}/{filename}', exist_ok=True)
-    combined_mesh = merge([skin_mesh, bone_mesh, heart_mesh, lung_mesh])
-    combined_mesh_no_bone = merge([skin_mesh, heart_mesh, lung_mesh])
-    save_mesh_to_stl(skin_mesh, f'{output_dir}/{filename}/{filename}_skin', decimation_factor)
-    save_mesh_to_stl(bone_mesh, f'{output_dir}/{filename}/{filename}_bone', decimation_factor)
-    save_mesh_to_stl(heart_mesh, f'{output_dir}/{filename}/{filename}_heart', decimation_factor)
-    save_mesh_to_stl(lung_mesh, f'{output_dir}/{filename}/{filename}_lung', decimation_factor)
-    save_mesh_to_stl(combined_mesh_no_bone, f'{output_dir}/{filename}/{filename}_combined_no_bone', decimation_factor)
-    save_mesh_to_stl(combined_mesh, f'{output_dir}/{filename}/{filename}_combined', decimation_factor)
     
-    print(f"STL files have been saved to {output_dir}/{filename}")
+    # Decimate each organ once and assemble the combined meshes from the decimated parts
+    factors = decimation_factor if isinstance(decimation_factor, dict) else dict.fromkeys(meshes, decimation_factor)
+    if any(factor < 1 for factor in factors.values()):
+        _report(progress, "Decimating meshes")
+        meshes = {organ: mesh.clone().decimate(factors[organ]) if factors[organ] < 1 else mesh
+                  for organ, mesh in meshes.items()}
+    
+    # Save meshes, the combined files are streamed from the organ meshes without merging them
+    _report(progress, f"Writing {fmt} files to {output_dir}/{filename}")
+    prefix = f'{output_dir}/{filename}/{filename}'
+    organs = {name: meshes[name] for name in ('skin', 'bone', 'heart', 'lung')}
+    combinations = {'combined_no_bone': ['skin', 'heart', 'lung'], 'combined': ['skin', 'bone', 'heart', 'lung']}
+    write_mesh_set(organs, prefix, fmt, combinations, colors=ORGAN_STYLES)
+    
+    print(f"{fmt.upper()} files have been saved to {output_dir}/{filename}")
+
+def export_stl(filename, volume_path, heart, lung, output_dir, decimation_factor=1, progress=None, workers=None,
+               fmt='stl', triangle_budget=None, max_error=None):
+    """
+    Create and export 3D meshes of the body outline, bones, heart, and lungs as STL files
+    Args:
+        volume_path: path to the body volume .nii.gz file
+        heart: path to the heart segmentation .nii.gz file
+        lung: path to the lung segmentation .nii.gz file
+        output_dir: directory to save STL files
+        decimation_factor: factor to reduce the number of triangles (0-1)
+        progress: optional callback receiving a message before each stage
+        workers: how the organs are built in parallel, see build_surfaces
+        fmt: output format, see write_stl_set
+        triangle_budget: total triangles of the four organs, shared by surface area (replaces decimation_factor)
+        max_error: largest Hausdorff distance in mm allowed for each organ (replaces decimation_factor)
+    """
+    meshes = build_organ_meshes(volume_path, heart, lung, progress, workers)
+    if triangle_budget is not None or max_error is not None:
+        _report(progress, "Planning decimation")
+        decimation_factor = plan_decimation(meshes, triangle_budget, max_error)
+    write_stl_set(meshes, filename, output_dir, decimation_factor, progress, fmt)
+
+def export_stl_levels(filename, volume_path, heart, lung, output_dir, decimation_factors, workers=None, fmt='stl',
+                      triangle_budget=None, max_error=None):
+    """
+    Export several decimation levels of one patient from a single isosurface and smoothing pass
+    Each level below 1 is written to output_dir/{filename}_reduce_{N}% where N is the
+    percentage of triangles removed, e.g. 0.25 -> {filename}_reduce_75%.
+    Args:
+        decimation_factors: list of factors to reduce the number of triangles (0-1)
+        workers: how the organs are built in parallel, see build_surfaces
+        fmt: output format, see write_stl_set
+        triangle_budget: total triangles of the four organs, shared by surface area; replaces
+                         decimation_factors with a single set written to planned_name(...)
+        max_error: largest Hausdorff distance in mm allowed for each organ, like triangle_budget
+    Returns:
+        list of the output folder names
+    """
+    meshes = build_organ_meshes(volume_path, heart, lung, workers=workers)
+    if triangle_budget is not None or max_error is not None:
+        name = planned_name(filename, triangle_budget, max_error)
+        write_stl_set(meshes, name, output_dir, plan_decimation(meshes, triangle_budget, max_error), fmt=fmt)
+        return [name]
+    names = []
+    for factor in decimation_factors:
+        name = level_name(filename, factor)
+        write_stl_set(meshes, name, output_dir, factor, fmt=fmt)
+        names.append(name)
+    return names
+
+def stl_set_paths(filename, output_dir, fmt='stl'):
+    """Return the files written by write_stl_set for filename"""
+    prefix = f'{output_dir}/{filename}/{filename}'
+    if fmt in ('glb', 'multi_stl'):
+        return [f"{prefix}.{'glb' if fmt == 'glb' else 'stl'}"]
+    names = ['skin', 'bone', 'heart', 'lung', 'combined_no_bone', 'combined']
+    return [f'{prefix}_{name}.{fmt}' for name in names]
+
+def level_name(filename, decimation_factor):
+    """Return the output name of one decimation level written by export_stl_levels"""
+    return filename if decimation_factor >= 1 else f'{filename}_reduce_{round((1 - decimation_factor) * 100)}%'
+
+def planned_name(filename, triangle_budget=None, max_error=None):
+    """Return the output name of a set decimated to a triangle budget or a maximum error by export_stl_levels"""
+    if triangle_budget is not None:
+        return f'{filename}_budget_{int(triangle_budget)}'
+    return f'{filename}_error_{max_error:g}mm'
+
+def get_patient_paths(volume_id, input_dir='input/volumes', segmentation_dir='output'):
+    """
+    Return the file name and the body, heart and lung paths of a patient volume
+    Args:
+        volume_id: volume number, e.g. 18 for volume_18
+    """
+    filename = f"volume_{volume_id}"
+    volume_path = f"{input_dir}/{filename}.nii.gz"
+    heart = f"{segmentation_dir}/{filename}/{filename}_Heart.nii.gz"
+    lung = f"{segmentation_dir}/{filename}/{filename}_Auto_Lung.nii.gz"
+    return filename, volume_path, heart, lung
+
+def _export_patient_task(volume_id, decimation_factors, input_dir, segmentation_dir, output_dir, fmt,
+                         triangle_budget, max_error):
+    """Worker side of batch_export_stl"""
+    filename, volume_path, heart, lung = get_patient_paths(volume_id, input_dir, segmentation_dir)
+    # Patients already run in parallel, so the organs of one patient are built in this process
+    return export_stl_levels(filename, volume_path, heart, lung, output_dir, decimation_factors, workers=1, fmt=fmt,
+                             triangle_budget=triangle_budget, max_error=max_error)
+
+def batch_export_stl(volume_ids, decimation_factors=(1,), input_dir='input/volumes', segmentation_dir='output',
+                     output_dir='./output_stl', workers=None, fmt='stl', on_done=None, triangle_budget=None,
+                     max_error=None):
+    """
+    Export STL files for many patients, one patient per worker process
+    Args:
+        volume_ids: list of volume numbers
+        decimation_factors: decimation levels written for every patient
+        input_dir: folder with the volume_N.nii.gz body volumes
+        segmentation_dir: folder with the volume_N/volume_N_Heart|Auto_Lung.nii.gz masks
+        output_dir: directory to save STL files
+        workers: number of worker processes (None for one per CPU)
+        fmt: output format, see write_stl_set
+        on_done: optional callback receiving each volume id as soon as its export succeeded
+        triangle_budget: total triangles of each patient, see export_stl_levels
+        max_error: largest Hausdorff distance in mm of each organ, see export_stl_levels
+    Returns:
+        {volume id: list of output folder names} for the patients that were exported
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_export_patient_task, volume_id, list(decimation_factors),
+                               input_dir, segmentation_dir, output_dir, fmt, triangle_budget, max_error): volume_id
+                   for volume_id in volume_ids}
+        for future in as_completed(futures):
+            volume_id = futures[future]
+            try:
+                results[volume_id] = future.result()
+            except (FileNotFoundError, ImageFileError) as e:
+                print(f"Failed to export volume_{volume_id}: {e}")
+                continue
+            if on_done is not None:
+                on_done(volume_id)
+    return results
+
+def _render_patient_task(volume_id, output_path, input_dir, segmentation_dir):
+    """Worker side of batch_render"""
+    filename, volume_path, heart, lung = get_patient_paths(volume_id, input_dir, segmentation_dir)
+    meshes = build_skin_bone_heart_lung_meshes(volume_path, heart, lung, workers=1)
+    return render_to_file(meshes, output_path, filename, azimuth=90)
+
+def batch_render(volume_ids, output_dir='./output_img', input_dir='input/volumes', segmentation_dir='output',
+                 workers=None, on_done=None):
+    """
+    Render the skin, bone, heart and lung view of many patients offscreen, one patient per worker process
+    Args:
+        volume_ids: list of volume numbers
+        output_dir: folder receiving volume_N.png
+        input_dir: folder with the volume_N.nii.gz body volumes
+        segmentation_dir: folder with the volume_N/volume_N_Heart|Auto_Lung.nii.gz masks
+        workers: number of worker processes (None for one per CPU)
+        on_done: optional callback receiving each volume id as soon as its image is written
+    Returns:
+        {volume id: image path} for the patients that were rendered
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_render_patient_task, volume_id, f'{output_dir}/volume_{volume_id}.png',
+                               input_dir, segmentation_dir): volume_id
+                   for volume_id in volume_ids}
+        for future in as_completed(futures):
+            volume_id = futures[future]
+            try:
+                results[volume_id] = future.result()
+            except (FileNotFoundError, ImageFileError) as e:
+                print(f"Failed to render volume_{volume_id}: {e}")
+                continue
+            if on_done is not None:
+                on_done(volume_id)
+    return results
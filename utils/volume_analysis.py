@@ -1,32 +1,222 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import nibabel as nib
 import numpy as np
-import os
 
-def calculate_volume(nifti_file):
-    """Calculate the volume of a structure from a NIFTI file"""
+try:
+    from utils.volume_cache import load_image, get_cached
+    from utils.volume_index import DEFAULT_INDEX_PATH, open_index, get_record, put_record, file_stamp
+except ImportError:
+    # Running as a script from inside the utils folder
+    from volume_cache import load_image, get_cached
+    from volume_index import DEFAULT_INDEX_PATH, open_index, get_record, put_record, file_stamp
+
+# Size of the slabs read by count_nonzero_voxels (16 MB)
+SLAB_BYTES = 16 * 1024 ** 2
+
+def count_nonzero_voxels(img, slab_bytes=SLAB_BYTES):
+    """
+    Count the voxels above zero by reading the image slab by slab through its dataobj
+    Args:
+        img: nibabel image (opened with keep_file_open=True for compressed files)
+        slab_bytes: approximate size of each slab read from the file
+    """
+    shape = img.shape
+    if len(shape) < 3:
+        return int(np.count_nonzero(np.asanyarray(img.dataobj) > 0))
+
+    # Slabs along the third axis, and one 3D volume at a time for 4D files, follow the on-disk order
+    slice_bytes = shape[0] * shape[1] * np.dtype(img.get_data_dtype()).itemsize
+    slab = max(1, slab_bytes // slice_bytes)
+    count = 0
+    for extra in np.ndindex(*shape[3:]):
+        for z in range(0, shape[2], slab):
+            chunk = img.dataobj[(slice(None), slice(None), slice(z, z + slab)) + extra]
+            count += int(np.count_nonzero(chunk > 0))
+    return count
+
+
+def measure_volume(nifti_file):
+    """Return the number of non-zero voxels and the voxel dimensions of a NIFTI file"""
+    img = load_image(nifti_file, keep_file_open=True)
+    zooms = img.header.get_zooms()
+    data = get_cached(nifti_file)
+    if data is not None:
+        voxel_count = int(np.count_nonzero(data > 0))
+    else:
+        voxel_count = count_nonzero_voxels(img)
+    return voxel_count, zooms
+
+
+def calculate_volume(nifti_file, index=None):
+    """
+    Calculate the volume of a structure from a NIFTI file
+    Args:
+        nifti_file: path to the .nii.gz file
+        index: optional connection from open_index; measurements are looked up
+               there first and stored after being computed
+    """
     try:
-        img = nib.load(nifti_file)
-        data = img.get_fdata()
+        record = get_record(index, nifti_file) if index is not None else None
+        if record is not None:
+            print(record['zooms'])
+            return record['volume']
+
+        stamp = file_stamp(nifti_file) if index is not None else None
         # Count non-zero voxels and multiply by voxel dimensions
-        voxel_volume = np.prod(img.header.get_zooms())
-        print(img.header.get_zooms())
-        return np.sum(data > 0) * voxel_volume
+        voxel_count, zooms = measure_volume(nifti_file)
+        print(zooms)
+        volume = voxel_count * np.prod(zooms[:3])
+        if index is not None:
+            put_record(index, nifti_file, voxel_count, zooms, volume, stamp)
+        return volume
     except (FileNotFoundError, nib.filebasedimages.ImageFileError) as e:
         print(f"Error loading {nifti_file}: {e}")
         return 0
     
 
-def get_nifti_path(volume_num, organ):
+def get_nifti_path(volume_num, organ, segmentation_dir="../output"):
     """Construct path to NIFTI file based on volume number and organ type"""
     filename = f"volume_{volume_num}"
     if organ.lower() == 'lung':
-        return f"../output/{filename}/{filename}_Auto_Lung.nii.gz"
+        return f"{segmentation_dir}/{filename}/{filename}_Auto_Lung.nii.gz"
     elif organ.lower() == 'heart':
-        return f"../output/{filename}/{filename}_Heart.nii.gz"
+        return f"{segmentation_dir}/{filename}/{filename}_Heart.nii.gz"
     else:
         raise ValueError(f"Unsupported organ type: {organ}")
 
-def compare_volumes(volume_numbers, organ_type, threshold_pct=1.0, output_file="None"):
+def _measure_task(nifti_file, stamped=False):
+    """
+    Worker side of measure_volumes; returns None when the file cannot be read
+    With stamped, the file_stamp for the index is also computed here, in parallel with the other files.
+    """
+    try:
+        stamp = file_stamp(nifti_file) if stamped else None
+        voxel_count, zooms = measure_volume(nifti_file)
+        return voxel_count, tuple(float(z) for z in zooms), stamp
+    except (FileNotFoundError, nib.filebasedimages.ImageFileError) as e:
+        print(f"Error loading {nifti_file}: {e}")
+        return None
+
+def measure_volumes(volume_numbers, organ_types, workers=None, index_path=DEFAULT_INDEX_PATH, segmentation_dir="../output"):
+    """
+    Measure many organ volumes in a process pool, yielding results as they complete
+    
+    Args:
+        volume_numbers: List of volume numbers to measure
+        organ_types: List of organs ('heart', 'lung')
+        workers: Number of worker processes (None for one per CPU, 1 to run in this process)
+        index_path: Volume index database; indexed files are not sent to the workers
+        segmentation_dir: Folder with the volume_N/volume_N_Heart|Auto_Lung.nii.gz masks
+    Yields:
+        (volume number, organ, volume in cubic mm) in completion order; a volume number
+        given more than once is measured and yielded once
+    """
+    # Duplicates would map to the same file and collapse into one pending measurement
+    volume_numbers = list(dict.fromkeys(volume_numbers))
+    index = open_index(index_path) if index_path else None
+    pending = {}
+    for organ in organ_types:
+        for vol_num in volume_numbers:
+            nifti_file = get_nifti_path(vol_num, organ, segmentation_dir)
+            try:
+                record = get_record(index, nifti_file) if index is not None else None
+            except FileNotFoundError as e:
+                print(f"Error loading {nifti_file}: {e}")
+                yield vol_num, organ, 0
+                continue
+            if record is not None:
+                yield vol_num, organ, record['volume']
+            else:
+                pending[nifti_file] = (vol_num, organ)
+
+    def finish(nifti_file, result):
+        vol_num, organ = pending[nifti_file]
+        if result is None:
+            return vol_num, organ, 0
+        voxel_count, zooms, stamp = result
+        volume = voxel_count * np.prod(zooms[:3])
+        if index is not None:
+            put_record(index, nifti_file, voxel_count, zooms, volume, stamp)
+        return vol_num, organ, volume
+
+    try:
+        if workers == 1:
+            for nifti_file in pending:
+                yield finish(nifti_file, _measure_task(nifti_file, index is not None))
+        elif pending:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(_measure_task, nifti_file, index is not None): nifti_file
+                           for nifti_file in pending}
+                for future in as_completed(futures):
+                    yield finish(futures[future], future.result())
+    finally:
+        if index is not None:
+            index.close()
+
+def collect_volumes(volume_numbers, organ_types, index_path=DEFAULT_INDEX_PATH, workers=1):
+    """Return {volume number: {organ: volume}} for every scan and organ"""
+    all_results = {vol: {} for vol in volume_numbers}
+    for vol_num, organ, volume in measure_volumes(volume_numbers, organ_types, workers, index_path):
+        all_results[vol_num][organ] = volume
+    return all_results
+
+def volume_difference_matrix(volumes):
+    """
+    Build the all-pairs difference matrices of a list of volumes
+    Args:
+        volumes: sequence of N volumes
+    Returns:
+        (diff, percent) N x N arrays where diff[i, j] = volumes[j] - volumes[i] and
+        percent[i, j] is that difference relative to volumes[i] (inf when volumes[i] is 0)
+    """
+    volumes = np.asarray(volumes, dtype=float)
+    diff = volumes[np.newaxis, :] - volumes[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percent = diff / volumes[:, np.newaxis] * 100
+    percent[volumes == 0, :] = np.inf
+    return diff, percent
+
+def compare_volumes_matrix(volume_numbers, organ_type, threshold_pct=1.0, output_prefix=None, index_path=DEFAULT_INDEX_PATH, workers=1):
+    """
+    Compare all pairs of scans at once with NumPy broadcasting
+    
+    Args:
+        volume_numbers: List of volume numbers to compare
+        organ_type: Type of organ ('heart', 'lung', or ['heart', 'lung'] for both)
+        threshold_pct: Pairs whose absolute percent difference is below this are selected
+        output_prefix: If set, writes {prefix}_{organ}_diff.csv, _percent.csv, _pairs.csv and .npz
+        index_path: Volume index database reused between calls (None to always recompute)
+        workers: Number of processes used to measure the volumes
+    Returns:
+        {organ: (diff, percent, mask)} with the N x N matrices and the threshold mask
+    """
+    organ_types = [organ_type] if isinstance(organ_type, str) else organ_type
+    all_results = collect_volumes(volume_numbers, organ_types, index_path, workers)
+    numbers = np.asarray(volume_numbers)
+
+    matrices = {}
+    for organ in organ_types:
+        volumes = np.array([all_results[vol_num][organ] for vol_num in volume_numbers])
+        diff, percent = volume_difference_matrix(volumes)
+        mask = np.abs(percent) < threshold_pct
+        matrices[organ] = (diff, percent, mask)
+
+        if output_prefix is not None:
+            header = ','.join(f"volume_{vol_num}" for vol_num in volume_numbers)
+            np.savetxt(f"{output_prefix}_{organ}_diff.csv", diff, fmt='%.2f', delimiter=',', header=header, comments='')
+            np.savetxt(f"{output_prefix}_{organ}_percent.csv", percent, fmt='%.2f', delimiter=',', header=header, comments='')
+            np.savez(f"{output_prefix}_{organ}.npz", volume_numbers=numbers, volumes=volumes,
+                     diff=diff, percent=percent, mask=mask)
+
+            # Each unordered pair once (i < j), as in compare_volumes
+            rows, cols = np.nonzero(np.triu(mask, k=1))
+            pairs = np.column_stack([numbers[rows], numbers[cols], diff[rows, cols], percent[rows, cols]])
+            np.savetxt(f"{output_prefix}_{organ}_pairs.csv", pairs, fmt=['%d', '%d', '%.2f', '%.2f'],
+                       delimiter=',', header='volume_1,volume_2,difference,percent', comments='')
+
+    return matrices
+
+def compare_volumes(volume_numbers, organ_type, threshold_pct=1.0, output_file="None", index_path=DEFAULT_INDEX_PATH, workers=1):
     """
     Compare organ volumes across different scans
     
@@ -35,6 +225,8 @@ def compare_volumes(volume_numbers, organ_type, threshold_pct=1.0, output_file="
         organ_type: Type of organ ('heart', 'lung', or ['heart', 'lung'] for both)
         threshold_pct: Threshold percentage for logging differences
         output_file: File to write results when difference is below threshold
+        index_path: Volume index database reused between calls (None to always recompute)
+        workers: Number of processes used to measure the volumes
     """
     if not volume_numbers or len(volume_numbers) < 1:
         print("Error: Need at least one volume number to analyze")
@@ -52,15 +244,8 @@ def compare_volumes(volume_numbers, organ_type, threshold_pct=1.0, output_file="
     elif len(organ_types) == 1:
         print(f"--- Analysis for {organ_types[0].capitalize()} ---")
     
-    # Initialize data structure to store volumes
-    all_results = {vol: {} for vol in volume_numbers}
-    
     # Calculate volumes for each scan and organ
-    for organ in organ_types:
-        for vol_num in volume_numbers:
-            nifti_file = get_nifti_path(vol_num, organ)
-            volume = calculate_volume(nifti_file)
-            all_results[vol_num][organ] = volume
+    all_results = collect_volumes(volume_numbers, organ_types, index_path, workers)
     
     # Print volumes grouped by volume number
     for vol_num in volume_numbers:
@@ -98,16 +283,41 @@ def compare_volumes(volume_numbers, organ_type, threshold_pct=1.0, output_file="
                     
             print()
 
-def record_volume_size(vol_num, organ, output_file="volume_sizes.txt"):
+def record_volume_size(vol_num, organ, output_file="volume_sizes.txt", index_path=DEFAULT_INDEX_PATH):
     """Record the volume of an organ to a text file"""
     nifti_file = get_nifti_path(vol_num, organ)
     # Calculate the volume using the existing function
-    volume = calculate_volume(nifti_file)
+    index = open_index(index_path) if index_path else None
+    volume = calculate_volume(nifti_file, index)
+    if index is not None:
+        index.close()
     
     # Write the volume information to the text file
     with open(output_file, 'a') as f:
         f.write(f"{organ}_volume_{vol_num}: {volume:.2f} cubic mm\n")
 
+def record_volume_sizes(volume_numbers, organ, output_file="volume_sizes.txt", workers=None, index_path=DEFAULT_INDEX_PATH,
+                        segmentation_dir="../output"):
+    """
+    Record the volumes of an organ for many scans, measured in parallel
+    Lines are written in the order of volume_numbers as soon as all earlier ones are known;
+    a volume number given more than once is recorded once.
+    """
+    volume_numbers = list(dict.fromkeys(volume_numbers))
+    order = {vol_num: position for position, vol_num in enumerate(volume_numbers)}
+    done = {}
+    next_position = 0
+    with open(output_file, 'a') as f:
+        for vol_num, _, volume in measure_volumes(volume_numbers, [organ], workers, index_path, segmentation_dir):
+            done[order[vol_num]] = (vol_num, volume)
+            while next_position in done:
+                num, size = done.pop(next_position)
+                f.write(f"{organ}_volume_{num}: {size:.2f} cubic mm\n")
+                f.flush()
+                next_position += 1
+    if next_position < len(volume_numbers):
+        raise RuntimeError(f"Recorded {next_position} of {len(volume_numbers)} {organ} volumes in {output_file}")
+
 if __name__ == "__main__":
     
     TempList = []
@@ -127,8 +337,13 @@ if __name__ == "__main__":
         # record_volume_size(i,'heart', 'heart_volume_sizes.txt')
         # record_volume_size(i,'lung', 'lung_volume_sizes.txt')
 
+    # record_volume_sizes(list(range(1, 182)), 'heart', 'heart_volume_sizes.txt', workers=8)
+    # record_volume_sizes(list(range(1, 182)), 'lung', 'lung_volume_sizes.txt', workers=8)
+
     # compare_volumes([12, 18], 'lung')
 
+    # compare_volumes_matrix(list(range(1, 182)), ['heart', 'lung'], 1.0, 'cohort')
+
     # print(calculate_volume(get_nifti_path(18, 'lung')))
 
     # print(TempList)
@@ -0,0 +1,190 @@
+from collections import OrderedDict
+import os
+import threading
+import nibabel as nib
+import numpy as np
+
+try:
+    from utils.volume_store import resolve_path
+except ImportError:
+    # Running as a script from inside the utils folder
+    from volume_store import resolve_path
+
+# Default memory budget for cached volumes (2 GB)
+DEFAULT_CACHE_BUDGET = 2 * 1024 ** 3
+
+# Memory-mapped volumes cost no resident memory but hold a file handle and a mapping each,
+# so their number is capped separately
+MAX_MAPPED_ENTRIES = 64
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_budget = DEFAULT_CACHE_BUDGET
+_mapped_entries = 0
+# Guards the cache when volumes are loaded from worker threads (e.g. the GUI)
+_cache_lock = threading.Lock()
+
+
+def _cache_key(path, dtype):
+    """Build the cache key for a file from its resolved path, mtime, size and requested dtype"""
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    dtype_name = None if dtype is None else np.dtype(dtype).str
+    return (real_path, stat.st_mtime_ns, stat.st_size, dtype_name)
+
+
+def _read_data(img, dtype):
+    """
+    Read the image data without upcasting it to float64
+    Args:
+        img: nibabel image
+        dtype: requested dtype, or None to keep the dtype stored on disk
+    """
+    if dtype is not None and np.issubdtype(np.dtype(dtype), np.floating):
+        # get_fdata applies the scaling in the requested precision directly
+        return img.get_fdata(dtype=dtype, caching='unchanged')
+    data = np.asanyarray(img.dataobj)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return data
+
+
+def _resident_bytes(data):
+    """Memory held by a cached array; memory-mapped arrays are paged in from disk on demand"""
+    return 0 if isinstance(data, np.memmap) else data.nbytes
+
+
+def _drop(key):
+    """Remove one entry from the cache and its accounting"""
+    global _cache_bytes, _mapped_entries
+    _, data = _cache.pop(key)
+    _cache_bytes -= _resident_bytes(data)
+    if isinstance(data, np.memmap):
+        _mapped_entries -= 1
+
+
+def _evict(budget):
+    """Drop least recently used entries until the cache fits in the budget and the mapping cap"""
+    while _cache and _cache_bytes > budget:
+        _drop(next(iter(_cache)))
+    if _mapped_entries > MAX_MAPPED_ENTRIES:
+        mapped = [key for key, (_, data) in _cache.items() if isinstance(data, np.memmap)]
+        for key in mapped[:_mapped_entries - MAX_MAPPED_ENTRIES]:
+            _drop(key)
+
+
+def load_image(path, keep_file_open=False):
+    """
+    Open a NIFTI image without reading its data, using the volume store when enabled
+    Args:
+        path: path to the .nii.gz file
+        keep_file_open: keep the (gzip) file handle open between dataobj slices
+    """
+    return nib.load(resolve_path(path), keep_file_open=keep_file_open)
+
+
+def get_cached(path, dtype=None):
+    """Return the cached data array for path, or None if it has not been loaded"""
+    key = _cache_key(resolve_path(path), dtype)
+    with _cache_lock:
+        entry = _cache.get(key)
+    return None if entry is None else entry[1]
+
+
+def load_nifti(path, dtype=None):
+    """
+    Load a NIFTI file through the process-wide volume cache
+    Args:
+        path: path to the .nii.gz file
+        dtype: dtype of the returned array, None keeps the dtype stored on disk
+               (float if the header defines a scaling). With the volume store
+               enabled and no conversion needed, the array is memory-mapped.
+    Returns:
+        (img, data) tuple of the nibabel image and its read-only data array
+    """
+    global _cache_bytes, _mapped_entries
+    path = resolve_path(path)
+    key = _cache_key(path, dtype)
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    img = nib.load(path)
+    data = _read_data(img, dtype)
+    # Cached arrays are shared between callers, so they must not be modified
+    data.flags.writeable = False
+
+    # Volumes larger than the whole budget are returned without being cached
+    size = _resident_bytes(data)
+    with _cache_lock:
+        if size <= _cache_budget and key not in _cache:
+            _cache[key] = (img, data)
+            _cache_bytes += size
+            _mapped_entries += isinstance(data, np.memmap)
+            _evict(_cache_budget)
+    return img, data
+
+
+def set_cache_budget(max_bytes):
+    """Set the maximum number of bytes of volume data kept in the cache"""
+    global _cache_budget
+    with _cache_lock:
+        _cache_budget = max_bytes
+        _evict(_cache_budget)
+
+
+def clear_cache():
+    """Remove every volume from the cache"""
+    global _cache_bytes, _mapped_entries
+    with _cache_lock:
+        _cache.clear()
+        _cache_bytes = 0
+        _mapped_entries = 0
+
+
+def cache_info():
+    """Return the number of cached (and memory-mapped) volumes, their total size and the budget in bytes"""
+    return {'entries': len(_cache), 'mapped': _mapped_entries, 'bytes': _cache_bytes, 'budget': _cache_budget}
+
+
+def report_memory_savings(paths, dtype=None):
+    """
+    Compare, from the headers only, the peak memory of get_fdata() against dtype-preserving loading
+    Args:
+        paths: list of NIFTI files
+        dtype: dtype that load_nifti would be called with (None for the on-disk dtype)
+    Returns:
+        (float64 peak bytes, compact peak bytes) summed over all files
+    """
+    total_fdata = 0
+    total_compact = 0
+    for path in paths:
+        try:
+            img = nib.load(path)
+        except (FileNotFoundError, nib.filebasedimages.ImageFileError) as e:
+            print(f"Error loading {path}: {e}")
+            continue
+        n_voxels = int(np.prod(img.shape))
+        disk_size = np.dtype(img.get_data_dtype()).itemsize
+        slope, inter = img.header.get_slope_inter()
+        scaled = slope not in (None, 1.0) or inter not in (None, 0.0)
+        if dtype is not None:
+            compact_size = np.dtype(dtype).itemsize
+        elif scaled:
+            compact_size = 8
+        else:
+            compact_size = disk_size
+        # get_fdata holds the raw on-disk array and the float64 copy at the same time
+        fdata_peak = n_voxels * (disk_size + 8)
+        if compact_size == disk_size:
+            compact_peak = n_voxels * disk_size
+        else:
+            compact_peak = n_voxels * (disk_size + compact_size)
+        total_fdata += fdata_peak
+        total_compact += compact_peak
+        print(f"{os.path.basename(path)}: {fdata_peak / 1024 ** 2:.1f} MB -> {compact_peak / 1024 ** 2:.1f} MB")
+
+    print(f"Total: {total_fdata / 1024 ** 2:.1f} MB -> {total_compact / 1024 ** 2:.1f} MB "
+          f"({(total_fdata - total_compact) / 1024 ** 2:.1f} MB saved)")
+    return total_fdata, total_compact
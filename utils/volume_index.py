@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import sqlite3
+
+# Location of the index database, overridable through the environment; set the variable to
+# an empty string to measure without an index
+DEFAULT_INDEX_PATH = os.environ.get(
+    'MRI_VOLUME_INDEX', os.path.join(os.path.expanduser('~'), '.cache', 'mri', 'volume_index.sqlite')) or None
+
+
+def open_index(index_path=DEFAULT_INDEX_PATH):
+    """Open (and create if needed) the volume measurement index"""
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    conn = sqlite3.connect(index_path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS volumes ("
+        "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, sha1 TEXT, "
+        "voxel_count INTEGER, zooms TEXT, volume REAL)"
+    )
+    return conn
+
+
+def file_digest(path, chunk_size=1024 ** 2):
+    """Return the SHA-1 of a file's content"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_record(conn, nifti_file):
+    """
+    Return the indexed measurement of a NIFTI file, or None if it is missing or stale
+    A record whose mtime or size changed is still valid if the file content hash is unchanged.
+    Args:
+        conn: connection returned by open_index
+        nifti_file: path to the .nii.gz file
+    """
+    real_path = os.path.realpath(nifti_file)
+    stat = os.stat(real_path)
+    row = conn.execute(
+        "SELECT mtime_ns, size, sha1, voxel_count, zooms, volume FROM volumes WHERE path = ?",
+        (real_path,)
+    ).fetchone()
+    if row is None:
+        return None
+
+    mtime_ns, size, sha1, voxel_count, zooms, volume = row
+    if (mtime_ns, size) != (stat.st_mtime_ns, stat.st_size):
+        if size != stat.st_size or file_digest(real_path) != sha1:
+            return None
+        # Only the timestamp changed (e.g. the file was copied), keep the measurement
+        with conn:
+            conn.execute("UPDATE volumes SET mtime_ns = ? WHERE path = ?", (stat.st_mtime_ns, real_path))
+
+    return {'voxel_count': voxel_count, 'zooms': tuple(json.loads(zooms)), 'volume': volume, 'sha1': sha1}
+
+
+def file_stamp(nifti_file):
+    """
+    Return the modification time, size and content hash identifying the version of a file
+    Take the stamp before measuring the file, so a file rewritten meanwhile is measured again later.
+    """
+    real_path = os.path.realpath(nifti_file)
+    stat = os.stat(real_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': file_digest(real_path)}
+
+
+def put_record(conn, nifti_file, voxel_count, zooms, volume, stamp=None):
+    """
+    Store the measurement of a NIFTI file in the index
+    Args:
+        stamp: file_stamp of the measured file, computed here if not given
+    """
+    real_path = os.path.realpath(nifti_file)
+    stamp = stamp or file_stamp(real_path)
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (real_path, stamp['mtime_ns'], stamp['size'], stamp['sha1'],
+             int(voxel_count), json.dumps([float(str(z)) for z in zooms]), float(volume))
+        )
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import nibabel as nib
+import numpy as np
+import vtk
+from vtk.util.numpy_support import numpy_to_vtk, vtk_to_numpy
+
+# The store is enabled by pointing this environment variable at a directory
+STORE_ENV_VAR = 'MRI_VOLUME_STORE'
+
+# Resampled volumes go to the store when it is enabled, otherwise to this folder
+DEFAULT_RESAMPLE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'mri', 'resampled')
+
+_store_dir = os.environ.get(STORE_ENV_VAR) or None
+
+
+def enable_store(store_dir):
+    """
+    Make load_nifti read volumes from an uncompressed, memory-mapped copy in store_dir
+    Args:
+        store_dir: directory holding the converted .nii files
+    """
+    global _store_dir
+    os.makedirs(store_dir, exist_ok=True)
+    _store_dir = store_dir
+
+
+def disable_store():
+    """Read volumes from their original files again"""
+    global _store_dir
+    _store_dir = None
+
+
+def get_store_dir():
+    """Return the active store directory, or None if the store is disabled"""
+    return _store_dir
+
+
+def store_path(nifti_path, store_dir, suffix=''):
+    """Return the path of the uncompressed copy of nifti_path inside store_dir"""
+    real_path = os.path.realpath(nifti_path)
+    name = os.path.basename(real_path)
+    for ext in ('.nii.gz', '.nii'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    # The hash of the full path keeps files with the same name in different folders apart
+    digest = hashlib.sha1(real_path.encode()).hexdigest()[:12]
+    return os.path.join(store_dir, f"{name}_{digest}{suffix}.nii")
+
+
+def _source_stamp(nifti_path):
+    """Return the mtime and size recorded for the source file of a stored volume"""
+    stat = os.stat(nifti_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def is_stored(nifti_path, store_dir, suffix=''):
+    """Check whether store_dir holds an up-to-date uncompressed copy of nifti_path"""
+    stored = store_path(nifti_path, store_dir, suffix)
+    try:
+        with open(f"{stored}.json") as f:
+            stamp = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    return os.path.exists(stored) and stamp == _source_stamp(nifti_path)
+
+
+def convert_to_store(nifti_path, store_dir=None):
+    """
+    Write an uncompressed copy of a NIFTI file that nibabel can memory-map
+    Args:
+        nifti_path: path to the .nii.gz file
+        store_dir: store directory, defaults to the active store
+    Returns:
+        path of the uncompressed .nii file
+    """
+    store_dir = store_dir or _store_dir
+    if store_dir is None:
+        raise ValueError("No volume store directory configured")
+    os.makedirs(store_dir, exist_ok=True)
+
+    stored = store_path(nifti_path, store_dir)
+    if is_stored(nifti_path, store_dir):
+        return stored
+
+    stamp = _source_stamp(nifti_path)
+    _save_stored(nib.load(nifti_path), stored, stamp)
+    return stored
+
+
+def _save_stored(img, stored, stamp):
+    """Write a stored volume and its source stamp"""
+    # Write to a temporary file first so concurrent readers never see a partial volume
+    tmp_path = f"{stored[:-len('.nii')]}.tmp{os.getpid()}.nii"
+    nib.save(img, tmp_path)
+    os.replace(tmp_path, stored)
+    # The stamp is replaced the same way, readers see either the old or the new one
+    tmp_stamp = f"{stored}.tmp{os.getpid()}.json"
+    with open(tmp_stamp, 'w') as f:
+        json.dump(stamp, f)
+    os.replace(tmp_stamp, f"{stored}.json")
+
+
+def resample_data(data, zooms, voxel_size, interpolation=1):
+    """
+    Resample a 3D array to isotropic voxels with VTK
+    Args:
+        data: 3D NumPy array
+        zooms: voxel size of data along each axis
+        voxel_size: voxel size of the output along every axis
+        interpolation: 0 nearest neighbour, 1 linear, 2 cubic
+    Returns:
+        float32 array on the new grid
+    """
+    data = np.asarray(data, dtype=np.float32)
+    image = vtk.vtkImageData()
+    image.SetDimensions(data.shape)
+    image.SetSpacing([float(z) for z in zooms])
+    # VTK stores the x index fastest, which is the Fortran order of the NIFTI array
+    image.GetPointData().SetScalars(numpy_to_vtk(data.ravel(order='F'), deep=True))
+
+    resample = vtk.vtkImageResample()
+    resample.SetInputData(image)
+    for axis in range(3):
+        resample.SetAxisOutputSpacing(axis, voxel_size)
+    resample.SetInterpolationMode(interpolation)
+    resample.Update()
+
+    output = resample.GetOutput()
+    shape = output.GetDimensions()
+    return vtk_to_numpy(output.GetPointData().GetScalars()).reshape(shape, order='F')
+
+
+def resample_isotropic(nifti_path, voxel_size=None, store_dir=None):
+    """
+    Return a copy of a NIFTI file resampled to isotropic voxels, computing it only once per file
+    The resampled volume is written to the store (or DEFAULT_RESAMPLE_DIR) and reused
+    until the source file changes.
+    Args:
+        nifti_path: path to the .nii.gz file
+        voxel_size: output voxel size in mm, None for the finest voxel size of the file
+        store_dir: folder for the resampled files, defaults to the active store
+    Returns:
+        path of the resampled .nii file
+    """
+    store_dir = store_dir or _store_dir or DEFAULT_RESAMPLE_DIR
+    img = nib.load(nifti_path)
+    zooms = img.header.get_zooms()[:3]
+    if voxel_size is None:
+        voxel_size = float(min(zooms))
+    suffix = f"_iso{voxel_size:g}mm"
+    stored = store_path(nifti_path, store_dir, suffix)
+    if is_stored(nifti_path, store_dir, suffix):
+        return stored
+
+    os.makedirs(store_dir, exist_ok=True)
+    stamp = _source_stamp(nifti_path)
+    data = resample_data(img.dataobj, zooms, voxel_size)
+    # Same orientation and first voxel, only the voxel size changes
+    affine = img.affine @ np.diag([voxel_size / z for z in zooms] + [1])
+    resampled = nib.Nifti1Image(data, affine)
+    resampled.header.set_zooms((voxel_size,) * 3)
+    _save_stored(resampled, stored, stamp)
+    return stored
+
+
+def build_store(nifti_paths, store_dir=None):
+    """Convert a list of NIFTI files into the store, skipping missing and up-to-date ones"""
+    stored = []
+    for nifti_path in nifti_paths:
+        if not os.path.exists(nifti_path):
+            print(f"Skipping missing file {nifti_path}")
+            continue
+        stored.append(convert_to_store(nifti_path, store_dir))
+    return stored
+
+
+def resolve_path(nifti_path):
+    """
+    Return the file that should be read for nifti_path
+    When the store is enabled, the volume is converted on first access and the
+    uncompressed copy is returned afterwards; otherwise nifti_path is returned unchanged.
+    """
+    if _store_dir is None or not nifti_path.endswith('.nii.gz'):
+        return nifti_path
+    return convert_to_store(nifti_path, _store_dir)
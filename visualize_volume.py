@@ -1,273 +1,60 @@
-from vedo import Volume, Plotter, Text2D, merge
-import nibabel as nib
+from utils.visualize_volume_functions import (build_skin_meshes, build_bone_meshes, build_heart_lung_meshes,
+                            build_skin_heart_lung_meshes, build_skin_bone_heart_lung_meshes,
+                            build_preview_meshes, show_meshes, show_progressive)
 
-def visualize_skin(volume_path):
+def visualize_skin(volume_path, title="MRI Visualization"):
     """
     Create a 3D visualization of the body outline using Plotter
     Args:
         volume_path: path to the .nii.gz file
+        title: text shown at the top of the window
     """
-    # Load the volume
-    img = nib.load(volume_path)
-    data = img.get_fdata()
+    show_meshes(build_skin_meshes(volume_path), title)
     
-    # Normalize the data to 0-1 range
-    data = (data - data.min()) / (data.max() - data.min())
-    
-    # Create volume with appropriate spacing
-    vol = Volume(data, spacing=(1,1,3))
-    
-    # Create isosurface mesh
-    mesh = vol.isosurface(0.1) # 0.1 is the threshold value for showing the skin
-    mesh.smooth(niter=20)
-    mesh.color('wheat')
-    mesh.alpha(0.9)
-    
-    # Create plotter instance with proper lighting
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D(filename, pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([mesh, txt])
-    
-    # Set camera position
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
-    
-    # Show the visualization with default lighting
-    plt.show(interactive=True)
-    
-def visualize_bone(volume_path):
+def visualize_bone(volume_path, title="MRI Visualization"):
     """
-    Create a 3D visualization of the body outline using Plotter
+    Create a 3D visualization of the bones using Plotter
     Args:
         volume_path: path to the .nii.gz file
+        title: text shown at the top of the window
     """
-    # Load the volume
-    img = nib.load(volume_path)
-    data = img.get_fdata()
+    show_meshes(build_bone_meshes(volume_path), title)
     
-    # Normalize the data to 0-1 range
-    data = (data - data.min()) / (data.max() - data.min())
-    
-    # Create volume with appropriate spacing
-    vol = Volume(data, spacing=(1,1,3))
-    
-    # Create isosurface mesh
-    mesh = vol.isosurface(0.75) # 0.75 is the threshold value for showing the bones
-    mesh.smooth(niter=20)
-    mesh.color('wheat')
-    mesh.alpha(0.9)
-    
-    # Create plotter instance with proper lighting
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D(filename, pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([mesh, txt])
-    
-    # Set camera position
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
-    
-    # Show the visualization with default lighting
-    plt.show(interactive=True)
-    
-def visualize_heart_lung(heart_path, lung_path):
+def visualize_heart_lung(heart_path, lung_path, title="MRI Visualization"):
     """
     Create a 3D visualization of the heart and lungs
     Args:
         heart_path: path to the heart segmentation .nii.gz file
         lung_path: path to the lung segmentation .nii.gz file
+        title: text shown at the top of the window
     """
-    # Load the volumes
-    heart_img = nib.load(heart_path)
-    lung_img = nib.load(lung_path)
-    
-    # Get data
-    heart_data = heart_img.get_fdata()
-    lung_data = lung_img.get_fdata()
-    
-    # Create volumes
-    heart_vol = Volume(heart_data, spacing=(1,1,3))
-    lung_vol = Volume(lung_data, spacing=(1,1,3))
-    
-    # Create meshes
-    heart_mesh = heart_vol.isosurface(0.5)
-    lung_mesh = lung_vol.isosurface(0.5)
-    
-    # Apply styling
-    heart_mesh.smooth(niter=20).color('red').alpha(0.8)
-    lung_mesh.smooth(niter=20).color('pink').alpha(0.6)
-    
-    # Create plotter
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D(filename, pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([heart_mesh, lung_mesh, txt])
-    
-    # Set camera
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
-    
-    plt.show(interactive=True)
+    show_meshes(build_heart_lung_meshes(heart_path, lung_path), title)
 
-def visualize_skin_heart_lung(volume_path, heart_path, lung_path):
+def visualize_skin_heart_lung(volume_path, heart_path, lung_path, title="MRI Visualization"):
     """
     Create a 3D visualization of the body outline, heart, and lungs
     Args:
         volume_path: path to the body volume .nii.gz file
         heart_path: path to the heart segmentation .nii.gz file
         lung_path: path to the lung segmentation .nii.gz file
+        title: text shown at the top of the window
     """
-    # Load the volumes
-    skin_img = nib.load(volume_path)
-    heart_img = nib.load(heart_path)
-    lung_img = nib.load(lung_path)
-    
-    # Get data and normalize
-    skin_data = skin_img.get_fdata()
-    skin_data = (skin_data - skin_data.min()) / (skin_data.max() - skin_data.min())
-    
-    heart_data = heart_img.get_fdata()
-    lung_data = lung_img.get_fdata()
-    
-    # Create volumes
-    skin_vol = Volume(skin_data, spacing=(1,1,3))
-    heart_vol = Volume(heart_data, spacing=(1,1,3))
-    lung_vol = Volume(lung_data, spacing=(1,1,3))
-    
-    # Create meshes
-    skin_mesh = skin_vol.isosurface(0.1)
-    heart_mesh = heart_vol.isosurface(0.5)
-    lung_mesh = lung_vol.isosurface(0.5)
-    
-    # Apply styling
-    skin_mesh.smooth(niter=20).color('wheat').alpha(0.3)
-    heart_mesh.smooth(niter=20).color('red').alpha(0.8)
-    lung_mesh.smooth(niter=20).color('pink').alpha(0.6)
-    
-    # Create plotter
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D(filename, pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([skin_mesh, heart_mesh, lung_mesh, txt])
-    
-    # Set camera
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(0)
-    
-    plt.show(interactive=True)
+    show_meshes(build_skin_heart_lung_meshes(volume_path, heart_path, lung_path), title)
 
-def visualize_skin_bone_heart_lung(volume_path, heart, lung):
+def visualize_skin_bone_heart_lung(volume_path, heart, lung, title="MRI Visualization", progressive=True):
     """
     Create a 3D visualization of the body outline, bones, heart, and lungs
     Args:
         volume_path: path to the body volume .nii.gz file
         heart: path to the heart segmentation .nii.gz file
         lung: path to the lung segmentation .nii.gz file
+        title: text shown at the top of the window
+        progressive: show a downsampled preview first and swap in each organ when it is ready
     """
-    # Load the volumes
-    skin_img = nib.load(volume_path)
-    heart_img = nib.load(heart)
-    lung_img = nib.load(lung)
-    
-    # Get data and normalize
-    skin_data = skin_img.get_fdata()
-    skin_data = (skin_data - skin_data.min()) / (skin_data.max() - skin_data.min())
-    
-    heart_data = heart_img.get_fdata()
-    lung_data = lung_img.get_fdata()
-    
-    # Create volumes
-    skin_vol = Volume(skin_data, spacing=(1,1,3))
-    heart_vol = Volume(heart_data, spacing=(1,1,3))
-    lung_vol = Volume(lung_data, spacing=(1,1,3))
-    
-    # Create meshes
-    skin_mesh = skin_vol.isosurface(0.1)
-    bone_mesh = skin_vol.isosurface(0.75)
-    heart_mesh = heart_vol.isosurface(0.5)
-    lung_mesh = lung_vol.isosurface(0.5)
-    
-    # Apply styling
-    skin_mesh.smooth(niter=20).color('wheat').alpha(0.3)
-    bone_mesh.smooth(niter=20).color('ivory').alpha(1)
-    heart_mesh.smooth(niter=20).color('red').alpha(1)
-    lung_mesh.smooth(niter=20).color('pink').alpha(1)
-    
-    # Create plotter
-    plt = Plotter(bg='black', size=(1000, 800), axes=1)
-    txt = Text2D(filename, pos='top-middle', s=1.5, c='white', bg='black', alpha=0.7)
-    plt.add([skin_mesh, bone_mesh, heart_mesh, lung_mesh, txt])
-    
-    # Set camera
-    plt.camera.Elevation(-90)
-    plt.camera.Azimuth(90)
-
-    plt.show(interactive=True)  
-
-def save_mesh_to_stl(mesh, name, decimation_factor):
-    """
-    Save a mesh to STL file with decimation
-    Args:
-        mesh: vedo mesh object
-        name: output filename (without extension)
-        decimation_factor: factor to reduce the number of triangles (0-1)
-    """
-    # Decimate the mesh to reduce polygon count
-    decimated_mesh = mesh.decimate(decimation_factor)
-    decimated_mesh.write(f'{name}.stl')
-
-def export_stl(filename, volume_path, heart, lung, output_dir, decimation_factor=1,):
-    """
-    Create and export 3D meshes of the body outline, bones, heart, and lungs as STL files
-    Args:
-        volume_path: path to the body volume .nii.gz file
-        heart: path to the heart segmentation .nii.gz file
-        lung: path to the lung segmentation .nii.gz file
-        output_dir: directory to save STL files
-        decimation_factor: factor to reduce the number of triangles (0-1)
-    """
-    # Load the volumes
-    skin_img = nib.load(volume_path)
-    heart_img = nib.load(heart)
-    lung_img = nib.load(lung)
-    
-    # Get data and normalize
-    skin_data = skin_img.get_fdata()
-    skin_data = (skin_data - skin_data.min()) / (skin_data.max() - skin_data.min())
-    
-    heart_data = heart_img.get_fdata()
-    lung_data = lung_img.get_fdata()
-    
-    # Create volumes
-    skin_vol = Volume(skin_data, spacing=(1,1,3))
-    heart_vol = Volume(heart_data, spacing=(1,1,3))
-    lung_vol = Volume(lung_data, spacing=(1,1,3))
-    
-    # Create meshes
-    skin_mesh = skin_vol.isosurface(0.1)
-    bone_mesh = skin_vol.isosurface(0.75)
-    heart_mesh = heart_vol.isosurface(0.5)
-    lung_mesh = lung_vol.isosurface(0.5)
-    
-    # Apply smoothing and decimation
-    skin_mesh.smooth(niter=20)
-    bone_mesh.smooth(niter=20)
-    heart_mesh.smooth(niter=20)
-    lung_mesh.smooth(niter=20)
-    
-    # Create output directory if it doesn't exist
-    import os
-    os.makedirs(output_dir, exist_ok=True)
-    
-    # Save meshes as STL
-    os.makedirs(f'{output_dir}/{filename}', exist_ok=True)
-    combined_mesh = merge([skin_mesh, bone_mesh, heart_mesh, lung_mesh])
-    combined_mesh_no_bone = merge([skin_mesh, heart_mesh, lung_mesh])
-    save_mesh_to_stl(skin_mesh, f'{output_dir}/{filename}/{filename}_skin', decimation_factor)
-    save_mesh_to_stl(bone_mesh, f'{output_dir}/{filename}/{filename}_bone', decimation_factor)
-    save_mesh_to_stl(heart_mesh, f'{output_dir}/{filename}/{filename}_heart', decimation_factor)
-    save_mesh_to_stl(lung_mesh, f'{output_dir}/{filename}/{filename}_lung', decimation_factor)
-    save_mesh_to_stl(combined_mesh_no_bone, f'{output_dir}/{filename}/{filename}_combined_no_bone', decimation_factor)
-    save_mesh_to_stl(combined_mesh, f'{output_dir}/{filename}/{filename}_combined', decimation_factor)
-    
-    print(f"STL files have been saved to {output_dir}/{filename}")
+    if progressive:
+        show_progressive(build_preview_meshes(volume_path, heart, lung), volume_path, heart, lung, title)
+    else:
+        show_meshes(build_skin_bone_heart_lung_meshes(volume_path, heart, lung), title, azimuth=90)
 
 if __name__ == "__main__":
 
@@ -286,18 +73,12 @@ if __name__ == "__main__":
     # heart = f"output/{filename1}/{filename1}_Heart.nii.gz"
     # lung = f"output/{filename1}/{filename1}_Auto_Lung.nii.gz"
 
-    # visualize_skin(volume_path)
-    # visualize_bone(volume_path)
-    # visualize_heart_lung(heart, lung)
-    # visualize_skin_heart_lung(volume_path, heart, lung)
-    visualize_skin_bone_heart_lung(volume_path, heart, lung)
+    # visualize_skin(volume_path, filename)
+    # visualize_bone(volume_path, filename)
+    # visualize_heart_lung(heart, lung, filename)
+    # visualize_skin_heart_lung(volume_path, heart, lung, filename)
+    visualize_skin_bone_heart_lung(volume_path, heart, lung, filename)
     # export_stl(filename, volume_path, heart, lung, output_dir='./output_stl')
 
-    # for i in [164]:
-    #     filename = f'volume_{i}'
-    #     volume_path = f"input/volumes/{filename}.nii.gz"
-    #     heart = f"output/{filename}/{filename}_Heart.nii.gz"
-    #     lung = f"output/{filename}/{filename}_Auto_Lung.nii.gz"
-    #     export_stl(f'{filename}_reduce_50%', volume_path, heart, lung, output_dir='./output_stl', decimation_factor=0.50)
-    #     export_stl(f'{filename}_reduce_75%', volume_path, heart, lung, output_dir='./output_stl', decimation_factor=0.25)
-    #     export_stl(f'{filename}_reduce_99%', volume_path, heart, lung, output_dir='./output_stl', decimation_factor=0.01)
+    # Exports the 50%, 75% and 99% reductions of each patient from one mesh build, patients in parallel
+    # batch_export_stl([164], decimation_factors=[0.50, 0.25, 0.01], output_dir='./output_stl')